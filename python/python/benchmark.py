@@ -0,0 +1,246 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+
+from .data import BatchSampler, TINYSHAKESPEARE as TEXT
+from .stages import STAGES, get_stage
+
+
+FORMAT_VERSION = 1
+
+## standard sizes: `small` is every stage section of script-final.py, `bigger` its
+## stage 12 run that stays under 16 GB
+SIZES = {
+    'tiny': {'batch_size': 4, 'block_size': 8, 'n_embed': 16, 'n_head': 2, 'n_layer': 1, 'dropout': 0.2},
+    'small': {'batch_size': 32, 'block_size': 8, 'n_embed': 32, 'n_head': 2, 'n_layer': 2, 'dropout': 0.2},
+    'bigger': {'batch_size': 16, 'block_size': 64, 'n_embed': 128, 'n_head': 4, 'n_layer': 4, 'dropout': 0.2},
+}
+
+## metric -> +1 if higher is better, -1 if lower is better
+METRICS = {
+    'step_seconds': -1,
+    'gradients_per_second': 1,
+    'tokens_per_second': 1,
+    'generation_tokens_per_second': 1,
+    'peak_rss_bytes': -1,
+    'checkpoint_bytes': -1,
+    'csv_bytes': -1,
+}
+
+
+def machine():
+    import bridgestan
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'bridgestan': getattr(bridgestan, '__version__', None)}
+
+
+def measure(stage, hyperparameters, model_lib=None, steps=20, warmup=3, max_new_tokens=200, text_path=TEXT):
+    """Time training steps and generation of one stage at one size, in this process.
+
+    A training step is drawing a batch from tinyshakespeare, serializing it,
+    the log density gradient and an AdamW update, run back to back (no
+    prefetching). Times are medians over `steps` steps after `warmup`.
+    Generation samples `max_new_tokens` tokens with the NumPy engine.
+    `peak_rss_bytes` is this process's peak, so measure each case in a
+    fresh process (as `run_benchmarks` does).
+    """
+    from .checkpoint import save_checkpoint
+    from .driver import StageDriver
+    from .inference import InferenceEngine
+    from .metrics import peak_rss_bytes
+    from .optim import AdamW
+    from .planner import plan
+    from .tokenizer import Tokenizer
+
+    stage = get_stage(stage)
+    with open(text_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    tokenizer = Tokenizer.from_text(text)
+    tokens = tokenizer.encode(text)
+    h = dict(hyperparameters, vocab_size=tokenizer.vocab_size)
+    sample = BatchSampler(tokens[:int(0.9 * len(tokens))], h['batch_size'], h['block_size'], seed=1337)
+    driver = StageDriver(stage, h, model_lib=model_lib)
+    optimizer = AdamW(lr=1e-3)
+
+    step_times, gradient_times = [], []
+    grad = None
+    for step in range(warmup + steps):
+        start = time.perf_counter()
+        data = driver.dump_data(*sample())
+        gradient_start = time.perf_counter()
+        _, grad = driver.log_density_gradient(data, out=grad)
+        gradient_end = time.perf_counter()
+        np.negative(grad, out=grad)
+        optimizer.step(driver.theta, grad)
+        end = time.perf_counter()
+        if step >= warmup:
+            step_times.append(end - start)
+            gradient_times.append(gradient_end - gradient_start)
+
+    state = driver.get_state()
+    engine = InferenceEngine(state.stan_variables(), stage)
+    start = time.perf_counter()
+    engine.generate(max_new_tokens=max_new_tokens, seed=0)
+    generation_seconds = time.perf_counter() - start
+
+    directory = tempfile.mkdtemp(prefix='benchmark-')
+    try:
+        save_checkpoint(directory, stage, h, state, tokenizer.chars)
+        checkpoint_bytes = sum(entry.stat().st_size for entry in os.scandir(directory))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    step_seconds = float(np.median(step_times))
+    p = plan(stage, h)
+    return {
+        'n_parameters': p.n_parameters,
+        'step_seconds': step_seconds,
+        'gradient_seconds': float(np.median(gradient_times)),
+        'gradients_per_second': 1.0 / float(np.median(gradient_times)),
+        'tokens_per_second': h['batch_size'] * h['block_size'] / step_seconds,
+        'generation_tokens_per_second': max_new_tokens / generation_seconds,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'checkpoint_bytes': checkpoint_bytes,
+        ## what one CmdStan optimize() call of script-final.py writes
+        'csv_bytes': p.csv_bytes,
+    }
+
+
+def _case(stage, hyperparameters, model_lib, options, queue):
+    try:
+        queue.put(measure(stage, hyperparameters, model_lib, **options))
+    except BaseException:
+        queue.put({'error': traceback.format_exc().strip().splitlines()[-1]})
+
+
+def run_benchmarks(stages=None, sizes=('tiny', 'small'), steps=20, warmup=3, max_new_tokens=200,
+                   text_path=TEXT, on_result=None):
+    """Benchmark every stage at every size, each case in a fresh process; returns the results document.
+
+    Models are compiled (or found) through the ModelRegistry first, so
+    compilation is never timed. Nothing is downloaded or read besides the
+    corpus at `text_path`.
+    """
+    from .registry import ModelRegistry
+
+    stages = [get_stage(stage) for stage in (stages or STAGES)]
+    registry = ModelRegistry()
+    libraries = {stage.name: registry.library(stage) for stage in stages}
+    options = {'steps': steps, 'warmup': warmup, 'max_new_tokens': max_new_tokens, 'text_path': text_path}
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for stage in stages:
+        for size in sizes:
+            hyperparameters = {name: SIZES[size][name] for name in stage.hyperparameters if name != 'vocab_size'}
+            queue = context.Queue()
+            process = context.Process(target=_case, args=(stage.name, hyperparameters,
+                                                          libraries[stage.name], options, queue))
+            process.start()
+            process.join()
+            result = queue.get() if process.exitcode == 0 else {'error': f"exit code {process.exitcode}"}
+            result = dict({'stage': stage.name, 'size': size, 'hyperparameters': hyperparameters}, **result)
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+    return {'format_version': FORMAT_VERSION, 'created': time.time(), 'machine': machine(),
+            'options': {'steps': steps, 'warmup': warmup, 'max_new_tokens': max_new_tokens},
+            'results': results}
+
+
+def save_results(path, document):
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(current, baseline, threshold=0.1, thresholds=None):
+    """Compare two results documents case by case.
+
+    A metric regresses when it is worse than the baseline by more than its
+    threshold, a fraction (`thresholds` overrides `threshold` per metric).
+    Returns one row per case and metric present in both:
+    (stage, size, metric, baseline, current, change, regressed), where
+    `change` is current / baseline - 1.
+    """
+    thresholds = thresholds or {}
+    before = {(r['stage'], r['size']): r for r in baseline['results'] if 'error' not in r}
+    rows = []
+    for result in current['results']:
+        old = before.get((result['stage'], result['size']))
+        if old is None or 'error' in result:
+            continue
+        for metric, direction in METRICS.items():
+            if metric not in result or metric not in old or not old[metric]:
+                continue
+            change = result[metric] / old[metric] - 1
+            regressed = direction * change < -thresholds.get(metric, threshold)
+            rows.append((result['stage'], result['size'], metric, old[metric], result[metric], change, regressed))
+    return rows
+
+
+def format_results(document):
+    lines = [f"{'stage':<32}{'size':<8}{'step ms':>10}{'grad/s':>10}{'tokens/s':>11}{'gen tok/s':>11}"
+             f"{'peak RSS':>11}{'checkpoint':>12}{'CSV':>10}"]
+    for r in document['results']:
+        if 'error' in r:
+            lines.append(f"{r['stage']:<32}{r['size']:<8}FAILED: {r['error']}")
+            continue
+        lines.append(f"{r['stage']:<32}{r['size']:<8}{1000 * r['step_seconds']:10.2f}{r['gradients_per_second']:10.1f}"
+                     f"{r['tokens_per_second']:11,.0f}{r['generation_tokens_per_second']:11,.0f}"
+                     f"{r['peak_rss_bytes'] / 1e6:9.0f}MB{r['checkpoint_bytes'] / 1e6:10.2f}MB"
+                     f"{r['csv_bytes'] / 1e6:8.2f}MB")
+    return "\n".join(lines)
+
+
+def format_comparison(rows):
+    lines = []
+    for stage, size, metric, old, new, change, regressed in rows:
+        flag = 'REGRESSION' if regressed else ''
+        lines.append(f"{stage:<32}{size:<8}{metric:<30}{old:14.4g}{new:14.4g}{100 * change:+8.1f}%  {flag}")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark training steps, generation and memory of the stage models.")
+    parser.add_argument('--stages', nargs='+')
+    parser.add_argument('--sizes', nargs='+', default=['tiny', 'small'], choices=list(SIZES))
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--max-new-tokens', type=int, default=200)
+    parser.add_argument('--text', default=TEXT)
+    parser.add_argument('--out', default='benchmark.json')
+    parser.add_argument('--baseline', help="results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="allowed fraction a metric may get worse")
+    parser.add_argument('--compare', nargs=2, metavar=('CURRENT', 'BASELINE'),
+                        help="only compare two saved results")
+    args = parser.parse_args()
+
+    if args.compare:
+        current, baseline = (load_results(path) for path in args.compare)
+    else:
+        current = run_benchmarks(args.stages, args.sizes, args.steps, args.warmup, args.max_new_tokens, args.text,
+                                 on_result=lambda r: print(f"{r['stage']} {r['size']}: "
+                                                           + (f"FAILED {r['error']}" if 'error' in r else
+                                                              f"{1000 * r['step_seconds']:.2f} ms/step")))
+        save_results(args.out, current)
+        print(format_results(current))
+        baseline = load_results(args.baseline) if args.baseline else None
+    if baseline is not None:
+        rows = compare(current, baseline, args.threshold)
+        print(format_comparison(rows))
+        if any(row[-1] for row in rows):
+            sys.exit(1)
@@ -0,0 +1,78 @@
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from .params import ParameterManifest, ParameterState
+from .stages import get_stage
+
+
+FORMAT_VERSION = 1
+METADATA_FILE = 'metadata.json'
+
+## A loaded checkpoint. `parameters` maps each parameter name to an array
+## (memory-mapped by default) in the shape stan_variables() would return.
+Checkpoint = namedtuple('Checkpoint', ['stage', 'hyperparameters', 'vocabulary', 'step', 'parameters'])
+
+
+def save_checkpoint(path, stage, hyperparameters, parameters, vocabulary, step=None):
+    """Write a checkpoint directory: metadata.json plus one .npy file per parameter.
+
+    `parameters` is a ParameterState or a `stan_variables()` dictionary (only
+    the stage's parameters are kept; transformed parameters and generated
+    quantities are not). `vocabulary` is the string of characters behind
+    token ids 1, 2, ...
+
+    Layout (format_version 1):
+        path/metadata.json       stage, hyperparameters, vocabulary, step and, per
+                                 parameter, its file, shape and dtype
+        path/<name>.npy          float64, little endian, row-major (C order)
+    """
+    stage = get_stage(stage)
+    manifest = ParameterManifest.for_stage(stage, hyperparameters)
+    if not isinstance(parameters, ParameterState):
+        parameters = ParameterState.from_stan_variables(manifest, parameters)
+    elif parameters.manifest != manifest:
+        raise ValueError(f"parameter state does not match stage {stage.name} "
+                         f"with hyperparameters {hyperparameters}")
+
+    os.makedirs(path, exist_ok=True)
+    entries = {}
+    for spec in manifest:
+        filename = spec.name + '.npy'
+        np.save(os.path.join(path, filename), parameters[spec.name].astype('<f8'))
+        entries[spec.name] = {'file': filename, 'shape': list(spec.shape), 'dtype': '<f8'}
+    metadata = {
+        'format_version': FORMAT_VERSION,
+        'stage': stage.name,
+        'hyperparameters': {name: hyperparameters[name] for name in stage.hyperparameters},
+        'vocabulary': ''.join(vocabulary),
+        'step': step,
+        'parameters': entries,
+    }
+    ## metadata last, so a directory with metadata.json is a complete checkpoint
+    with open(os.path.join(path, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def load_checkpoint(path, mmap=True):
+    """Read a checkpoint written by save_checkpoint.
+
+    With `mmap` (the default) the parameter arrays are read-only memory maps,
+    so loading costs a few file opens whatever the model size.
+    """
+    with open(os.path.join(path, METADATA_FILE)) as f:
+        metadata = json.load(f)
+    version = metadata.get('format_version')
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path}: unsupported checkpoint format_version {version!r}; "
+                         f"expecting {FORMAT_VERSION}")
+    parameters = {}
+    for name, entry in metadata['parameters'].items():
+        array = np.load(os.path.join(path, entry['file']), mmap_mode='r' if mmap else None)
+        if list(array.shape) != entry['shape']:
+            raise ValueError(f"{path}: {entry['file']} has shape {array.shape}, expecting {entry['shape']}")
+        parameters[name] = array
+    return Checkpoint(get_stage(metadata['stage']), metadata['hyperparameters'],
+                      metadata['vocabulary'], metadata['step'], parameters)
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+## the corpus bundled with the repository
+TINYSHAKESPEARE = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'data',
+                                               'tinyshakespeare', 'input.txt'))
+
+
+class BatchSampler:
+    """Random minibatches of (input, target) windows from an encoded corpus.
+
+    The corpus is never copied: every window of `block_size` tokens is a row
+    of a strided view over it, so a batch is one fancy-indexing gather for
+    the inputs and one for the targets (the window starting one token
+    later). Offsets are drawn without replacement, like `random.sample`.
+
+    With a `seed`, the stream of batches is reproducible:
+
+        sampler = BatchSampler(data_train, batch_size, block_size, seed=1337)
+        xb, yb = sampler.sample()
+    """
+
+    def __init__(self, data, batch_size, block_size, seed=None, dtype=np.int32):
+        data = np.asarray(data)
+        if len(data) <= block_size:
+            raise ValueError(f"need more than block_size={block_size} tokens, got {len(data)}")
+        self.batch_size = batch_size
+        self.block_size = block_size
+        self.dtype = dtype
+        self.rng = np.random.default_rng(seed)
+        ## windows[i] = data[i:i + block_size]; the last one only serves as a target
+        self._windows = sliding_window_view(data, block_size)
+        self._n_offsets = len(data) - block_size
+
+    def sample(self):
+        """One (xb, yb) pair of contiguous (batch_size, block_size) arrays."""
+        idx = self.rng.choice(self._n_offsets, self.batch_size, replace=False)
+        x = self._windows[idx].astype(self.dtype)
+        y = self._windows[idx + 1].astype(self.dtype)
+        return x, y
+
+    def __iter__(self):
+        while True:
+            yield self.sample()
+
+    __call__ = sample
+
+
+_default_rng = np.random.default_rng()
+
+
+def get_data_batch(data, batch_size, block_size, rng=None):
+    """Draw batch_size random windows from data: inputs x and targets y shifted by one token."""
+    rng = _default_rng if rng is None else rng
+    windows = sliding_window_view(np.asarray(data), block_size)
+    idx = rng.choice(len(windows) - 1, batch_size, replace=False)
+    return windows[idx].astype(np.int32), windows[idx + 1].astype(np.int32)
@@ -0,0 +1,190 @@
+import json
+import os
+
+import numpy as np
+import bridgestan
+
+from .params import ParameterManifest, ParameterState
+from .registry import ModelRegistry
+from .stages import get_stage, stage_data
+
+
+class StageDriver:
+    """Evaluate a compiled stage model in-process, one minibatch at a time.
+
+    The Stan program is compiled to a shared library once (through BridgeStan,
+    into the ModelRegistry) and stays loaded. Each minibatch instantiates the
+    model with new data, which only parses the data and runs the transformed
+    data block; there is no process to start, no CSV to write and nothing to
+    read back. The unconstrained parameters live in `theta` between steps.
+
+    Stages 04 to 12 sum the log likelihood of the sequences in a batch with
+    `reduce_sum`. With `threads_per_step` the model is compiled with
+    `STAN_THREADS=true` (a `model_lib` passed in must have been built that
+    way) and each step's batch is split across that many threads (-1 for one
+    per core). Stan's thread pool belongs to the process
+    and is set up when the first threaded model is loaded, so every driver in
+    a process runs with the first setting.
+
+    Usage:
+        driver = StageDriver('07', hyperparameters)
+        lp, grad = driver.log_density_gradient(driver.dump_data(xb, yb))
+        driver.theta += step_size * grad
+    """
+
+    def __init__(self, stage, hyperparameters, model_lib=None, seed=1234, init_radius=0.1,
+                 stanc_args=(), make_args=(), threads_per_step=None):
+        self.stage = get_stage(stage)
+        self.hyperparameters = dict(hyperparameters)
+        self.threads_per_step = threads_per_step
+        make_args = list(make_args)
+        if threads_per_step is not None:
+            if threads_per_step == 0 or threads_per_step < -1:
+                raise ValueError(f"threads_per_step must be positive or -1, got {threads_per_step}")
+            if 'STAN_THREADS=true' not in make_args:
+                make_args.append('STAN_THREADS=true')
+            os.environ['STAN_NUM_THREADS'] = str(threads_per_step)
+        if model_lib is None:
+            model_lib = ModelRegistry().library(self.stage, stanc_args, make_args)
+        self.model_lib = str(model_lib)
+        self.init_radius = init_radius
+        self.model = None
+        self.theta = None
+        self._names = {}
+        self._state_index = None
+        self._initial_state = None
+        self._seed = seed
+        self._rng = np.random.default_rng(seed)
+
+    def dump_data(self, xb, yb, xb_val=None, yb_val=None, max_new_tokens=0, **overrides):
+        """Serialize a minibatch into the JSON string the model is instantiated with.
+
+        Keyword arguments override hyperparameters for this batch only,
+        e.g. `dropout=0.0` for evaluation.
+        """
+        hyperparameters = dict(self.hyperparameters, **overrides) if overrides else self.hyperparameters
+        data = stage_data(self.stage, hyperparameters,
+                          np.asarray(xb).tolist(), np.asarray(yb).tolist(),
+                          None if xb_val is None else np.asarray(xb_val).tolist(),
+                          None if yb_val is None else np.asarray(yb_val).tolist(),
+                          max_new_tokens)
+        return json.dumps(data)
+
+    def load(self, data):
+        """Instantiate the model with `data` (a JSON string or dict) and make it current.
+
+        Every instantiation gets a fresh seed so that the random dropout masks
+        drawn in transformed data change from step to step, as they do
+        between successive CmdStan runs.
+        """
+        if not isinstance(data, str):
+            data = json.dumps(data)
+        self._seed += 1
+        self.model = bridgestan.StanModel(self.model_lib, data, seed=self._seed, warn=False)
+        if self.theta is None:
+            if self._initial_state is not None:
+                self.theta = self._initial_state.values[self._state_order()]
+                self._initial_state = None
+            else:
+                self.theta = self._rng.uniform(-self.init_radius, self.init_radius,
+                                               self.model.param_unc_num())
+        return self.model
+
+    def _model_for(self, data):
+        if data is not None:
+            return self.load(data)
+        if self.model is None:
+            raise RuntimeError("no data loaded; pass data or call load() first")
+        return self.model
+
+    def log_density(self, data=None, theta=None):
+        model = self._model_for(data)
+        return model.log_density(self.theta if theta is None else theta,
+                                 propto=False, jacobian=False)
+
+    def log_density_gradient(self, data=None, theta=None, out=None):
+        """Log density and its gradient with respect to the unconstrained parameters.
+
+        Without `data` the current model is reused; without `theta` the
+        driver's own parameters are used.
+        """
+        model = self._model_for(data)
+        return model.log_density_gradient(self.theta if theta is None else theta,
+                                          propto=False, jacobian=False, out=out)
+
+    @property
+    def manifest(self):
+        return ParameterManifest.for_stage(self.stage, self.hyperparameters)
+
+    def _state_order(self):
+        ## Position in the state buffer of each entry of theta. All parameters are
+        ## unconstrained, so unconstraining 0, 1, 2, ... reads off the permutation
+        ## between Stan's unconstrained order and its (column-major) constrained one.
+        if self._state_index is None:
+            manifest = self.manifest
+            names = list(dict.fromkeys(name.split('.')[0] for name in self.param_names()))
+            if names != manifest.names:
+                raise ValueError(f"parameters of {self.model_lib} do not match stage {self.stage.name}")
+            positions = self.model.param_unconstrain(np.arange(manifest.size, dtype=np.float64))
+            self._state_index = manifest.constrained_order()[positions.astype(np.intp)]
+        return self._state_index
+
+    def get_state(self):
+        """The current parameters as a ParameterState (a copy of `theta`, reordered)."""
+        index = self._state_order()
+        values = np.empty(len(index))
+        values[index] = self.theta
+        return ParameterState(self.manifest, values)
+
+    def set_state(self, state):
+        """Replace the parameters, e.g. with a state from another driver or a CmdStan fit.
+
+        Before any data is loaded the state is kept and becomes the initial
+        value of `theta` on the first `load()`.
+        """
+        if state.manifest != self.manifest:
+            raise ValueError(f"parameter state does not match stage {self.stage.name} "
+                             f"with hyperparameters {self.hyperparameters}")
+        if self.model is None:
+            self._initial_state = state.copy()
+        else:
+            self.theta = state.values[self._state_order()]
+
+    def param_names(self, include_tp=False, include_gq=False):
+        ## names do not depend on the data, so ask the library once
+        key = (include_tp, include_gq)
+        if key not in self._names:
+            self._names[key] = self._model_for(None).param_names(include_tp=include_tp,
+                                                                 include_gq=include_gq)
+        return self._names[key]
+
+    def transformed_parameter(self, name, data=None, theta=None):
+        """Read one scalar transformed parameter, e.g. 'loss'."""
+        model = self._model_for(data)
+        names = self.param_names(include_tp=True)
+        values = model.param_constrain(self.theta if theta is None else theta, include_tp=True)
+        return values[names.index(name)]
+
+    def loss(self, data=None, theta=None):
+        return self.transformed_parameter('loss', data, theta)
+
+    def generated_quantities(self, data=None, theta=None, seed=None):
+        """Run the generated quantities block once.
+
+        Returns a name -> value dictionary covering parameters, transformed
+        parameters and generated quantities. Scalars come back as floats and
+        containers as flat arrays in Stan's (column major) order, e.g.
+        result['new_tokens'].
+        """
+        model = self._model_for(data)
+        rng = model.new_rng(self._seed if seed is None else seed)
+        values = model.param_constrain(self.theta if theta is None else theta,
+                                       include_tp=True, include_gq=True, rng=rng)
+        names = self.param_names(include_tp=True, include_gq=True)
+        out = {}
+        for name, value in zip(names, values):
+            if '.' in name:
+                out.setdefault(name.split('.')[0], []).append(value)
+            else:
+                out[name] = value
+        return {name: (np.array(v) if isinstance(v, list) else v) for name, v in out.items()}
@@ -0,0 +1,311 @@
+import numpy as np
+
+from .stages import get_stage
+
+
+def _layer_norm(x, weight, bias):
+    ## Same as layer_norm() in the Stan programs: sample variance plus 1e-5,
+    ## and an all-zero vector (an empty slot in the context) stays zero.
+    mean = x.mean(axis=-1, keepdims=True)
+    sd = np.sqrt(x.var(axis=-1, ddof=1, keepdims=True) + 1e-5)
+    nonzero = np.abs(x).sum(axis=-1, keepdims=True) > 1e-8
+    return np.where(nonzero, (x - mean) / sd * weight + bias, 0.0)
+
+
+def _relu(x):
+    return np.maximum(x, 0.0)
+
+
+def _softmax(x):
+    x = x - x.max(axis=-1, keepdims=True)
+    np.exp(x, out=x)
+    x /= x.sum(axis=-1, keepdims=True)
+    return x
+
+
+def _stack_heads(w):
+    ## (n_head, n_embed, head_size) -> (n_embed, n_head * head_size): one product
+    ## computes every head, and head h lands in columns h * head_size onwards
+    return np.ascontiguousarray(w.transpose(1, 0, 2).reshape(w.shape[1], -1))
+
+
+class KVCache:
+    """Keys and values of every position seen so far, per layer.
+
+    Arrays are (batch, n_head, block_size, head_size); slot t holds the key
+    or value of the token at position t of the context window.
+    """
+
+    def __init__(self, n_layer, batch_size, n_head, block_size, head_size):
+        shape = (batch_size, n_head, block_size, head_size)
+        self.keys = [np.zeros(shape) for _ in range(n_layer)]
+        self.values = [np.zeros(shape) for _ in range(n_layer)]
+
+
+class InferenceEngine:
+    """Forward pass and token generation for a fitted stage model, in NumPy.
+
+    Takes the parameters as returned by `stan_variables()` (CmdStanPy), so
+    sampling text from a trained model needs no compiled Stan program.
+    Logits match the generated quantities block of the stage: tokens are
+    1-indexed, the context is the last `block_size` tokens, and layer norm
+    uses the sample standard deviation.
+
+    Generation keeps a key/value cache per layer: while the context is
+    shorter than `block_size`, each new token only runs its own position
+    through the network. Once the context window is full it slides, which
+    moves every token to a new position embedding, so from then on the
+    window is recomputed for each token (still as one batched forward pass).
+
+    Stages 11 and 12 apply dropout masks that are drawn in the Stan
+    program's transformed data. By default the engine runs without dropout
+    (as the reference does for generation); pass `dropout_masks` with
+    'dropout_sa_head' (n_layer, n_head, block_size, block_size),
+    'dropout_feedforward' and 'dropout_multi_headed_attention'
+    (n_layer, n_embed) to reproduce a particular run.
+    """
+
+    def __init__(self, stan_variables, stage, dropout_masks=None):
+        self.stage = get_stage(stage)
+        number = int(self.stage.name[:2])
+        p = {name: np.asarray(value, dtype=np.float64) for name, value in stan_variables.items()}
+
+        self.token_embedding = p['token_embedding']
+        self.vocab_size = self.token_embedding.shape[0]
+        self.lm_head = (p['lm_head_multiplier'], p['lm_head_offset']) if number >= 2 else None
+        self.position_embedding = p['position_embedding'] if number >= 3 else None
+        self.block_size = None if self.position_embedding is None else self.position_embedding.shape[0]
+
+        ## stages 05 to 09 have a single block and 04 a single head: add the missing dimensions
+        self.layers = []
+        if number >= 4:
+            key, query, value = p['key'], p['query'], p['value']
+            if number == 4:
+                key, query, value = key[None], query[None], value[None]
+            if number < 10:
+                key, query, value = key[None], query[None], value[None]
+            n_layer = key.shape[0]
+
+            def per_layer(name):
+                if name not in p:
+                    return [None] * n_layer
+                return list(p[name]) if number >= 10 else [p[name]]
+
+            masks = dropout_masks or {}
+            sa_head = masks.get('dropout_sa_head', [None] * n_layer)
+            feedforward = masks.get('dropout_feedforward', [None] * n_layer)
+            multi_head = masks.get('dropout_multi_headed_attention', [None] * n_layer)
+
+            for layer, (ff_w, ff_b, proj_w, proj_b, sa_w, sa_b, ln1_w, ln1_b, ln2_w, ln2_b) in enumerate(zip(
+                    per_layer('feed_forward_multiplier'), per_layer('feed_forward_offset'),
+                    per_layer('feed_forward_proj_multiplier'), per_layer('feed_forward_proj_offset'),
+                    per_layer('sa_proj_multiplier'), per_layer('sa_proj_offset'),
+                    per_layer('ln1_weight'), per_layer('ln1_bias'),
+                    per_layer('ln2_weight'), per_layer('ln2_bias'))):
+                self.layers.append({
+                    'key': _stack_heads(key[layer]),
+                    'query': _stack_heads(query[layer]),
+                    'value': _stack_heads(value[layer]),
+                    'sa_proj': None if sa_w is None else (sa_w, sa_b),
+                    'ln1': None if ln1_w is None else (ln1_w, ln1_b),
+                    'ln2': None if ln2_w is None else (ln2_w, ln2_b),
+                    'feed_forward': None if ff_w is None else (ff_w, ff_b),
+                    'feed_forward_proj': None if proj_w is None else (proj_w, proj_b),
+                    'dropout_sa_head': None if sa_head[layer] is None else np.asarray(sa_head[layer]),
+                    'dropout_feedforward': None if feedforward[layer] is None else np.asarray(feedforward[layer]),
+                    'dropout_multi_head': None if multi_head[layer] is None else np.asarray(multi_head[layer]),
+                })
+            self.n_head, self.n_embed, self.head_size = key.shape[1:]
+        self.skip_connections = number >= 7
+        self.ln_f = (p['ln_f_weight'], p['ln_f_bias']) if number >= 10 else None
+
+    def new_cache(self, batch_size):
+        if not self.layers:
+            return None
+        return KVCache(len(self.layers), batch_size, self.n_head, self.block_size, self.head_size)
+
+    def _attention(self, layer, x, positions, cache, rows, index):
+        ## x: (batch, n, n_embed) for the tokens at `positions` (batch, n),
+        ## belonging to sequences `rows` of the cache (None: all of them)
+        batch_size, n, _ = x.shape
+        q = (x @ layer['query']).reshape(batch_size, n, self.n_head, self.head_size)
+        k = (x @ layer['key']).reshape(batch_size, n, self.n_head, self.head_size)
+        v = (x @ layer['value']).reshape(batch_size, n, self.n_head, self.head_size)
+        keys, values = cache.keys[index], cache.values[index]
+        write_rows = np.arange(batch_size) if rows is None else rows
+        keys[write_rows[:, None], :, positions] = k
+        values[write_rows[:, None], :, positions] = v
+        if rows is not None:
+            keys, values = keys[rows], values[rows]
+
+        ## (batch, n_head, n, block_size); a query only sees keys at or before its position
+        scores = np.einsum('bnhd,bhtd->bhnt', q, keys) / np.sqrt(self.head_size)
+        visible = np.arange(self.block_size)[None, None, :] <= positions[:, :, None]
+        scores = np.where(visible[:, None], scores, -np.inf)
+        wei = _softmax(scores)
+        if layer['dropout_sa_head'] is not None:
+            wei *= layer['dropout_sa_head'][:, positions].transpose(1, 0, 2, 3)
+        out = np.einsum('bhnt,bhtd->bnhd', wei, values).reshape(batch_size, n, self.n_head * self.head_size)
+
+        if layer['sa_proj'] is not None:
+            out = out @ layer['sa_proj'][0].T + layer['sa_proj'][1]
+        if layer['dropout_multi_head'] is not None:
+            out = out * layer['dropout_multi_head']
+        return out
+
+    def _feed_forward(self, layer, x):
+        w, b = layer['feed_forward']
+        h = _relu(x @ w.T + b)
+        if layer['feed_forward_proj'] is not None:
+            h = h @ layer['feed_forward_proj'][0].T + layer['feed_forward_proj'][1]
+        if layer['dropout_feedforward'] is not None:
+            h = h * layer['dropout_feedforward']
+        return h
+
+    def forward(self, tokens, start=0, cache=None, rows=None):
+        """Logits for `tokens` (batch, n), 1-indexed, placed at positions start..start + n - 1.
+
+        `start` is a position shared by the batch or one per sequence. With
+        a cache, keys and values of earlier positions are read from it and
+        those of these tokens are written into it; `rows` selects the
+        sequences of the cache the batch belongs to (default: all of them).
+        Returns the (batch, n, vocab_size) logits.
+        """
+        x = self.activations(tokens, start, cache, rows)
+        if self.lm_head is None:
+            return x
+        return x @ self.lm_head[0].T + self.lm_head[1]
+
+    def activations(self, tokens, start=0, cache=None, rows=None):
+        """The (batch, n, n_embed) activations that feed the lm_head, same arguments as forward().
+
+        These are what the stage programs used to emit as the transformed
+        parameter `x`: `engine.activations(xb)` recomputes them for a batch
+        when they are needed for debugging. Stage 01 has no lm_head and
+        returns its logits.
+        """
+        tokens = np.asarray(tokens, dtype=np.intp) - 1
+        batch_size, n = tokens.shape
+        positions = np.broadcast_to(np.asarray(start)[..., None] + np.arange(n), (batch_size, n))
+        if cache is None:
+            cache = self.new_cache(batch_size)
+        rows = None if rows is None else np.asarray(rows)
+
+        x = self.token_embedding[tokens]
+        if self.position_embedding is not None:
+            x = x + self.position_embedding[positions]
+
+        for index, layer in enumerate(self.layers):
+            h = x if layer['ln1'] is None else _layer_norm(x, *layer['ln1'])
+            attention = self._attention(layer, h, positions, cache, rows, index)
+            x = x + attention if self.skip_connections else attention
+            if layer['feed_forward'] is not None:
+                h = x if layer['ln2'] is None else _layer_norm(x, *layer['ln2'])
+                x = x + self._feed_forward(layer, h) if self.skip_connections else self._feed_forward(layer, h)
+
+        if self.ln_f is not None:
+            x = _layer_norm(x, *self.ln_f)
+        return x
+
+    def sample(self, logits, rng, temperature=1.0, top_k=None):
+        """Draw one 1-indexed token per row of `logits`, like categorical_logit_rng.
+
+        Logits are divided by `temperature` (0 takes the most likely token)
+        and, with `top_k`, all but the k largest of each row are dropped.
+        """
+        logits = np.array(logits, dtype=np.float64)
+        if temperature == 0:
+            return logits.argmax(axis=-1) + 1
+        if temperature != 1.0:
+            logits /= temperature
+        if top_k is not None and top_k < logits.shape[-1]:
+            kth = np.partition(logits, -top_k, axis=-1)[:, -top_k, None]
+            logits[logits < kth] = -np.inf
+        probs = _softmax(logits)
+        u = rng.random((probs.shape[0], 1))
+        tokens = (np.cumsum(probs, axis=-1) < u).sum(axis=-1)
+        return np.minimum(tokens, self.vocab_size - 1) + 1
+
+    def generate_batch(self, prompts, max_new_tokens=500, seed=None, rng=None, encode=None,
+                       temperature=1.0, top_k=None):
+        """Sample `max_new_tokens` tokens after each prompt, all prompts at once.
+
+        `prompts` is a list of 1-indexed token sequences, or of strings when
+        `encode` (e.g. from encoder_decoder_1_indexed) is given; their
+        lengths may differ. Returns the (len(prompts), max_new_tokens) array
+        of continuations.
+
+        Context windows are right-padded to a common width. Attention is
+        causal, so padding never reaches a real position, and each
+        sequence's logits are read at its own last token. Each decode step
+        is then one batched forward pass for the sequences whose window
+        still grows (through the KV cache) and one for those whose window
+        has started to slide.
+        """
+        rng = np.random.default_rng(seed) if rng is None else rng
+        if encode is not None:
+            prompts = [encode(prompt) for prompt in prompts]
+        out = np.empty((len(prompts), max_new_tokens), dtype=np.intp)
+        for i, new_tokens in enumerate(self.decode(prompts, max_new_tokens, rng, temperature, top_k)):
+            out[:, i] = new_tokens
+        return out
+
+    def decode(self, prompts, max_new_tokens=500, rng=None, temperature=1.0, top_k=None):
+        """Yield the array of next tokens, one per prompt, as each decode step is sampled.
+
+        The loop behind generate_batch(). Nothing is computed ahead: the
+        first tokens come right after the prompts' forward pass, and each
+        following step's forward pass only runs when the next one is asked
+        for, so a consumer can stop at any point without wasted work.
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        prompts = [np.asarray(prompt, dtype=np.intp).ravel() for prompt in prompts]
+        if any(len(prompt) == 0 for prompt in prompts):
+            raise ValueError("prompts must contain at least one token")
+        batch_size = len(prompts)
+        block_size = self.block_size or 1
+
+        ## windows: the last block_size tokens of each sequence, padded with token 1
+        windows = np.ones((batch_size, block_size), dtype=np.intp)
+        lengths = np.empty(batch_size, dtype=np.intp)
+        for b, prompt in enumerate(prompts):
+            tail = prompt[-block_size:]
+            windows[b, :len(tail)] = tail
+            lengths[b] = len(tail)
+
+        cache = self.new_cache(batch_size)
+        everyone = np.arange(batch_size)
+        logits = self.forward(windows[:, :lengths.max()], 0, cache)[everyone, lengths - 1]
+        for i in range(max_new_tokens):
+            new_tokens = self.sample(logits, rng, temperature, top_k)
+            yield new_tokens
+            if i == max_new_tokens - 1:
+                break
+
+            growing = lengths < block_size
+            sliding = ~growing
+            windows[growing, lengths[growing]] = new_tokens[growing]
+            lengths[growing] += 1
+            windows[sliding, :-1] = windows[sliding, 1:]
+            windows[sliding, -1] = new_tokens[sliding]
+
+            if growing.any():
+                rows = everyone[growing]
+                logits[rows] = self.forward(new_tokens[rows, None], lengths[rows] - 1, cache, rows)[:, -1]
+            if sliding.any():
+                rows = everyone[sliding]
+                logits[rows] = self.forward(windows[rows], 0, cache, rows)[:, -1]
+
+    def generate(self, context=(1,), max_new_tokens=500, seed=None, rng=None, temperature=1.0, top_k=None):
+        """Sample `max_new_tokens` tokens after `context` and return context + new tokens.
+
+        `context` is one sequence of 1-indexed tokens, or a 2-d array of
+        equal-length sequences that are generated in parallel. The default
+        context, token 1, is how the Stan programs start `new_tokens`.
+        """
+        tokens = np.asarray(context, dtype=np.intp)
+        single = tokens.ndim == 1
+        tokens = np.atleast_2d(tokens)
+        out = np.concatenate([tokens, self.generate_batch(list(tokens), max_new_tokens, seed, rng,
+                                                          temperature=temperature, top_k=top_k)], axis=1)
+        return out[0] if single else out
@@ -0,0 +1,145 @@
+import argparse
+import http.client
+import json
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def connect(url, timeout=60):
+    """A connection to the server at `url`: 'http://host:port' or 'unix:/path/to/socket'."""
+    if url.startswith('unix:'):
+        return UnixHTTPConnection(url[len('unix:'):], timeout=timeout)
+    parsed = urlparse(url)
+    return http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+
+
+def generate(connection, stream=True, **request):
+    """Send one /generate request; returns (first_piece_seconds, total_seconds, tokens, text).
+
+    With `stream`, the time to the first piece is when the first line of
+    the chunked response arrives; without, it equals the total.
+    """
+    start = time.perf_counter()
+    connection.request('POST', '/generate', json.dumps(dict(request, stream=stream)),
+                       {'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    if response.status != 200:
+        raise RuntimeError(f"server returned {response.status}: {response.read().decode()}")
+    if not stream:
+        body = json.loads(response.read())
+        seconds = time.perf_counter() - start
+        return seconds, seconds, body['tokens'], body['text']
+    first, pieces = None, []
+    while True:
+        raw = response.readline()
+        if not raw:
+            raise RuntimeError("the server closed the stream before the request was done")
+        line = json.loads(raw)
+        if first is None:
+            first = time.perf_counter() - start
+        if line.get('done'):
+            break
+        pieces.append(line['text'])
+    response.read()
+    return first, time.perf_counter() - start, line['tokens'], ''.join(pieces)
+
+
+def run_load(url, n_requests=200, concurrency=16, stream=True, **request):
+    """Send `n_requests` generation requests from `concurrency` clients at once.
+
+    Each client thread keeps one connection and sends its next request as
+    soon as the last one finished. Returns the throughput and the p50 / p99
+    of the time to the first piece and of the whole request.
+    """
+    counter = iter(range(n_requests))
+    lock = threading.Lock()
+    results, errors = [], []
+
+    def client():
+        connection = connect(url)
+        try:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                try:
+                    result = generate(connection, stream, **dict(request, seed=request.get('seed', 0) + i))
+                ## ValueError: a response cut off in the middle of a JSON object
+                except (OSError, RuntimeError, ValueError, KeyError, http.client.HTTPException) as e:
+                    with lock:
+                        errors.append(repr(e))
+                    connection.close()
+                    connection = connect(url)
+                    continue
+                with lock:
+                    results.append(result)
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    first = np.array([r[0] for r in results])
+    total = np.array([r[1] for r in results])
+    tokens = sum(r[2] for r in results)
+    percentile = lambda a, q: float(np.percentile(a, q)) if len(a) else None
+    return {
+        'requests': len(results), 'errors': len(errors), 'concurrency': concurrency, 'seconds': seconds,
+        'requests_per_second': len(results) / seconds, 'tokens_per_second': tokens / seconds,
+        'first_piece_p50': percentile(first, 50), 'first_piece_p99': percentile(first, 99),
+        'latency_p50': percentile(total, 50), 'latency_p99': percentile(total, 99),
+    }
+
+
+def format_load(report):
+    ms = lambda s: '-' if s is None else f"{1000 * s:.1f} ms"
+    return "\n".join([
+        f"{report['requests']} requests ({report['errors']} errors), {report['concurrency']} at a time, "
+        f"{report['seconds']:.1f} s",
+        f"  throughput     {report['requests_per_second']:.1f} requests/s, {report['tokens_per_second']:,.0f} tokens/s",
+        f"  first piece    p50 {ms(report['first_piece_p50'])}, p99 {ms(report['first_piece_p99'])}",
+        f"  latency        p50 {ms(report['latency_p50'])}, p99 {ms(report['latency_p99'])}",
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure throughput and latency of the generation server.")
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help="http://host:port or unix:/path")
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--prompt', default='ROMEO:')
+    parser.add_argument('--max-new-tokens', type=int, default=100)
+    parser.add_argument('--temperature', type=float, default=1.0)
+    parser.add_argument('--top-k', type=int)
+    parser.add_argument('--model')
+    parser.add_argument('--no-stream', action='store_true')
+    args = parser.parse_args()
+
+    request = {'prompt': args.prompt, 'max_new_tokens': args.max_new_tokens, 'temperature': args.temperature}
+    if args.top_k:
+        request['top_k'] = args.top_k
+    if args.model:
+        request['model'] = args.model
+    for concurrency in args.concurrency:
+        print(format_load(run_load(args.url, args.requests, concurrency, not args.no_stream, **request)))
@@ -0,0 +1,187 @@
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import cmdstanpy
+
+from .stages import get_stage
+
+
+def peak_rss_bytes(children=False):
+    """Peak resident memory of this process (or of its largest finished child, e.g. CmdStan)."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    ## kilobytes on Linux, bytes on macOS
+    return usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def _children_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class MetricsLog:
+    """Per-step phase timings of a training loop, appended to a JSONL file.
+
+    Wrap each part of a step in `with metrics.phase(name):` (or report a
+    duration with `add(name, seconds)`), then call `step(step, **values)` at
+    the end of the step. That writes one JSON object per line with the
+    stage, step, wall time of the step, seconds per phase, tokens per second,
+    peak RSS of this process and of CmdStan, plus any `values` (losses, ...).
+
+    Records are grouped by `run` in the summary (the stage name unless
+    given), so two runs of one stage with different settings stay apart.
+    Every MetricsLog also stamps its records with a fresh `run_id`: when a
+    run is repeated into the same file, the summary only keeps the records
+    of the last one rather than merging them.
+
+    Phases may be reported from background threads (the prefetcher samples
+    and serializes batches while a step runs). They count towards the step
+    in which they finish and overlap the main thread's phases, so the phases
+    of a step need not add up to its wall time.
+    """
+
+    def __init__(self, path, stage, tokens_per_step=None, run=None):
+        self.path = path
+        self.stage = get_stage(stage).name
+        self.run = run or self.stage
+        self.run_id = uuid.uuid4().hex
+        self.tokens_per_step = tokens_per_step
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._step_start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._phases[name] = self._phases.get(name, 0.0) + seconds
+
+    def step(self, step, **values):
+        """Close the current step: write its record and start timing the next one."""
+        now = time.perf_counter()
+        seconds, self._step_start = now - self._step_start, now
+        with self._lock:
+            phases, self._phases = self._phases, {}
+        record = {'run': self.run, 'run_id': self.run_id, 'stage': self.stage, 'step': step, 'time': time.time(),
+                  'step_seconds': seconds, 'phases': phases}
+        if self.tokens_per_step:
+            record['tokens_per_second'] = self.tokens_per_step / seconds
+        record['peak_rss_bytes'] = peak_rss_bytes()
+        record['peak_child_rss_bytes'] = peak_rss_bytes(children=True)
+        record.update(values)
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        return record
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def timed_optimize(metrics, model, data, previous, **kwargs):
+    """One CmdStan `optimize()` call started from `previous` fit's parameters, timed by phase.
+
+    Phases:
+        read_outputs     `previous.stan_variables()`, the fit's output read back as arrays
+        write_inits      those arrays serialized to the JSON init file
+        cmdstan          CPU time of the CmdStan process: the model itself
+        process_and_csv  the rest of the call: starting and waiting on the process,
+                         and cmdstanpy writing its arguments and parsing the output CSV
+    """
+    with metrics.phase('read_outputs'):
+        inits = previous.stan_variables()
+    fd, inits_file = tempfile.mkstemp(prefix='inits-', suffix='.json')
+    os.close(fd)
+    try:
+        with metrics.phase('write_inits'):
+            cmdstanpy.write_stan_json(inits_file, inits)
+        cpu = _children_cpu_seconds()
+        start = time.perf_counter()
+        fit = model.optimize(data=data, inits=inits_file, **kwargs)
+        wall = time.perf_counter() - start
+        cpu = _children_cpu_seconds() - cpu
+    finally:
+        os.remove(inits_file)
+    metrics.add('cmdstan', cpu)
+    metrics.add('process_and_csv', max(wall - cpu, 0.0))
+    return fit
+
+
+def read_metrics(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records):
+    """Per run: steps, total seconds, throughput, peak memory and phases ranked by total time.
+
+    A run that was logged more than once (the same `run` with several
+    `run_id`s) is summarized from its last repetition only.
+    """
+    last = {}
+    for record in records:
+        last[record.get('run', record['stage'])] = record.get('run_id')
+    runs = {}
+    for record in records:
+        if record.get('run_id') != last[record.get('run', record['stage'])]:
+            continue
+        s = runs.setdefault(record.get('run', record['stage']),
+                            {'steps': 0, 'seconds': 0.0, 'tokens_per_second': [], 'peak_rss_bytes': 0,
+                             'peak_child_rss_bytes': 0, 'phases': {}})
+        s['steps'] += 1
+        s['seconds'] += record['step_seconds']
+        if 'tokens_per_second' in record:
+            s['tokens_per_second'].append(record['tokens_per_second'])
+        s['peak_rss_bytes'] = max(s['peak_rss_bytes'], record.get('peak_rss_bytes', 0))
+        s['peak_child_rss_bytes'] = max(s['peak_child_rss_bytes'], record.get('peak_child_rss_bytes', 0))
+        for name, seconds in record['phases'].items():
+            s['phases'][name] = s['phases'].get(name, 0.0) + seconds
+        for key in ('loss', 'loss_validation'):
+            if key in record:
+                s[key] = record[key]
+    for s in runs.values():
+        rates = s.pop('tokens_per_second')
+        s['tokens_per_second'] = sum(rates) / len(rates) if rates else None
+        s['phases'] = sorted(((name, seconds, seconds / s['seconds'] if s['seconds'] else 0.0)
+                              for name, seconds in s['phases'].items()), key=lambda p: -p[1])
+    return runs
+
+
+def format_summary(summary):
+    lines = []
+    for run, s in summary.items():
+        line = f"{run}: {s['steps']} steps, {s['seconds']:.1f} s"
+        if s['tokens_per_second']:
+            line += f", {s['tokens_per_second']:,.0f} tokens/s"
+        line += f", peak RSS {s['peak_rss_bytes'] / 1e6:.0f} MB (CmdStan {s['peak_child_rss_bytes'] / 1e6:.0f} MB)"
+        if 'loss' in s:
+            line += f", last loss {s['loss']:.4f}"
+        if 'loss_validation' in s:
+            line += f" / {s['loss_validation']:.4f}"
+        lines.append(line)
+        for name, seconds, share in s['phases']:
+            lines.append(f"  {name:<18}{seconds:10.2f} s  {100 * share:5.1f}%  {1000 * seconds / s['steps']:9.2f} ms/step")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:] or ['metrics.jsonl']:
+        print(format_summary(summarize(read_metrics(path))))
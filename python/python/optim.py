@@ -0,0 +1,146 @@
+import math
+
+import numpy as np
+
+
+## Learning-rate schedules: callables from the step number (starting at 0) to a learning rate.
+
+def constant_schedule(lr):
+    return lambda step: lr
+
+
+def cosine_schedule(lr, max_steps, warmup_steps=0, min_lr=0.0):
+    """Linear warmup to `lr`, then cosine decay down to `min_lr` at `max_steps`."""
+    def schedule(step):
+        if step < warmup_steps:
+            return lr * (step + 1) / warmup_steps
+        progress = min(1.0, (step - warmup_steps) / max(1, max_steps - warmup_steps))
+        return min_lr + 0.5 * (lr - min_lr) * (1 + math.cos(math.pi * progress))
+    return schedule
+
+
+def step_schedule(lr, step_size, gamma=0.1):
+    """Multiply the learning rate by `gamma` every `step_size` steps."""
+    return lambda step: lr * gamma ** (step // step_size)
+
+
+class Optimizer:
+    """Base class for first-order optimizers over a flat parameter vector.
+
+    `step(params, grad)` updates `params` in place to *decrease* the
+    objective whose gradient is `grad`. Buffers (momentum, moments) are
+    allocated on the first step and kept for the lifetime of the optimizer,
+    so state carries over from one minibatch to the next.
+    """
+
+    def __init__(self, lr, weight_decay):
+        self.schedule = lr if callable(lr) else constant_schedule(lr)
+        self.weight_decay = weight_decay
+        self.t = 0
+
+    @property
+    def lr(self):
+        return self.schedule(self.t)
+
+    def step(self, params, grad):
+        raise NotImplementedError
+
+    def state_dict(self):
+        return {'t': self.t}
+
+    def load_state_dict(self, state):
+        self.t = int(state['t'])
+
+
+class SGD(Optimizer):
+    """Stochastic gradient descent with optional momentum and L2 weight decay."""
+
+    def __init__(self, lr=1e-2, momentum=0.0, weight_decay=0.0):
+        super().__init__(lr, weight_decay)
+        self.momentum = momentum
+        self.velocity = None
+
+    def step(self, params, grad):
+        lr = self.lr
+        if self.weight_decay:
+            grad = grad + self.weight_decay * params
+        if self.momentum:
+            if self.velocity is None:
+                self.velocity = np.zeros_like(params)
+            self.velocity *= self.momentum
+            self.velocity += grad
+            grad = self.velocity
+        params -= lr * grad
+        self.t += 1
+
+    def state_dict(self):
+        return {'t': self.t, 'velocity': self.velocity}
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.velocity = state.get('velocity')
+
+
+class Adam(Optimizer):
+    """Adam (Kingma & Ba, 2015). Weight decay here is L2, added to the gradient."""
+
+    decoupled_weight_decay = False
+
+    def __init__(self, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.0):
+        super().__init__(lr, weight_decay)
+        self.beta1, self.beta2 = betas
+        self.eps = eps
+        self.m = None
+        self.v = None
+        self._buffer = None
+
+    def step(self, params, grad):
+        if self.m is None:
+            self.m = np.zeros_like(params)
+            self.v = np.zeros_like(params)
+        if self._buffer is None:
+            self._buffer = np.empty_like(params)
+        lr = self.lr
+        self.t += 1
+
+        if self.weight_decay:
+            if self.decoupled_weight_decay:
+                params *= 1 - lr * self.weight_decay
+            else:
+                grad = grad + self.weight_decay * params
+
+        ## m = beta1 * m + (1 - beta1) * g;  v = beta2 * v + (1 - beta2) * g^2
+        self.m *= self.beta1
+        self.m += (1 - self.beta1) * grad
+        np.multiply(grad, grad, out=self._buffer)
+        self.v *= self.beta2
+        self.v += (1 - self.beta2) * self._buffer
+
+        ## params -= lr * m_hat / (sqrt(v_hat) + eps), with the bias corrections folded in
+        bias_correction1 = 1 - self.beta1 ** self.t
+        bias_correction2 = 1 - self.beta2 ** self.t
+        np.sqrt(self.v, out=self._buffer)
+        self._buffer /= math.sqrt(bias_correction2)
+        self._buffer += self.eps
+        np.divide(self.m, self._buffer, out=self._buffer)
+        params -= (lr / bias_correction1) * self._buffer
+
+    def state_dict(self):
+        return {'t': self.t, 'm': self.m, 'v': self.v}
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.m = state.get('m')
+        self.v = state.get('v')
+
+
+class AdamW(Adam):
+    """Adam with decoupled weight decay (Loshchilov & Hutter, 2019).
+
+    Defaults match torch.optim.AdamW, which `reference/gpt-dev.py` uses.
+    """
+
+    decoupled_weight_decay = True
+
+    def __init__(self, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01):
+        super().__init__(lr, betas, eps, weight_decay)
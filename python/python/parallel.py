@@ -0,0 +1,212 @@
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from .driver import StageDriver
+
+
+class SharedArray:
+    """A NumPy array backed by a named shared memory block.
+
+    The process that creates it owns the block and unlinks it on `close()`;
+    other processes attach by name with `SharedArray.attach(name, shape, dtype)`.
+    """
+
+    def __init__(self, shape, dtype=np.float64, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self._owner = name is None
+        self._shm = shared_memory.SharedMemory(name=name, create=self._owner, size=size)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    @classmethod
+    def attach(cls, name, shape, dtype=np.float64):
+        return cls(shape, dtype, name=name)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def spec(self):
+        return self.name, self.shape, self.dtype.str
+
+    def close(self):
+        self.array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _worker(rank, stage, hyperparameters, model_lib, seed, threads_per_step, shared,
+            start, done, stop, errors):
+    ## One shard per step: wait for the coordinator to publish the batch, write this
+    ## shard's log density and gradient into row `rank`, then wait for the others.
+    arrays = {key: SharedArray.attach(*spec) for key, spec in shared.items()}
+    theta, grads, lps = arrays['theta'].array, arrays['grads'].array, arrays['lps'].array
+    xb, yb = arrays['xb'].array, arrays['yb'].array
+    rows = slice(rank * hyperparameters['batch_size'], (rank + 1) * hyperparameters['batch_size'])
+    try:
+        driver = StageDriver(stage, hyperparameters, model_lib=model_lib, seed=seed,
+                             threads_per_step=threads_per_step)
+        ## parameters are read straight out of shared memory, never copied
+        driver.theta = theta
+        while True:
+            start.wait()
+            if stop.is_set():
+                break
+            lps[rank], _ = driver.log_density_gradient(driver.dump_data(xb[rows], yb[rows]),
+                                                       out=grads[rank])
+            done.wait()
+    except threading.BrokenBarrierError:
+        pass
+    except BaseException:
+        errors.put(f"worker {rank}:\n{traceback.format_exc()}")
+        start.abort()
+        done.abort()
+    finally:
+        theta = grads = lps = xb = yb = None
+        for array in arrays.values():
+            array.close()
+
+
+class DataParallel:
+    """Synchronous data-parallel gradients over local worker processes.
+
+    Each step the global batch (the driver's `batch_size` sequences) is split
+    into `n_workers` shards. Every worker holds its own instance of the
+    driver's compiled model and evaluates the log density and gradient of
+    one shard. The coordinator averages them, which, since each stage model
+    averages its loss over the batch, is the gradient of the whole batch.
+
+    Nothing goes through files or pipes. The parameters, the batch and the
+    per-worker gradients live in shared memory: the driver's `theta` is
+    replaced by a shared buffer, so an optimizer step on `driver.theta` is
+    what every worker reads on the next step.
+
+        with DataParallel(driver, n_workers=8) as workers:
+            train(driver, optimizer, get_batch, max_iters, workers=workers)
+
+    Workers are started with the 'spawn' method, so scripts using this need
+    an `if __name__ == '__main__':` guard. `threads_per_step` is passed to the
+    workers' drivers (it needs a model library built with STAN_THREADS).
+
+    A worker that dies (even from a signal) or a step that takes longer than
+    `timeout` seconds makes `log_density_gradient` raise RuntimeError
+    instead of waiting forever.
+    """
+
+    def __init__(self, driver, n_workers, threads_per_step=None, seed=None, timeout=600):
+        batch_size = driver.hyperparameters['batch_size']
+        if n_workers < 1 or batch_size % n_workers:
+            raise ValueError(f"batch_size {batch_size} does not split into {n_workers} equal shards")
+        self.driver = driver
+        self.n_workers = n_workers
+        self.timeout = timeout
+        if driver.theta is None:
+            ## instantiate the model once so that theta exists (or a pending set_state applies)
+            ones = np.ones((batch_size, driver.hyperparameters['block_size']), dtype=np.int64)
+            driver.load(driver.dump_data(ones, ones))
+
+        block_size = driver.hyperparameters['block_size']
+        self._theta = SharedArray(driver.theta.shape)
+        self._theta.array[:] = driver.theta
+        driver.theta = self._theta.array
+        self._grads = SharedArray((n_workers, len(driver.theta)))
+        self._lps = SharedArray((n_workers,))
+        self._xb = SharedArray((batch_size, block_size), np.int32)
+        self._yb = SharedArray((batch_size, block_size), np.int32)
+        shared = {'theta': self._theta.spec(), 'grads': self._grads.spec(), 'lps': self._lps.spec(),
+                  'xb': self._xb.spec(), 'yb': self._yb.spec()}
+
+        context = multiprocessing.get_context('spawn')
+        self._start = context.Barrier(n_workers + 1)
+        self._done = context.Barrier(n_workers + 1)
+        self._stop = context.Event()
+        self._errors = context.Queue()
+        shard = dict(driver.hyperparameters, batch_size=batch_size // n_workers)
+        seed = driver._seed if seed is None else seed
+        ## seeds far apart: each driver adds one per step for fresh dropout masks
+        self._processes = [context.Process(target=_worker, daemon=True,
+                                           args=(rank, driver.stage.name, shard, driver.model_lib,
+                                                 seed + (rank + 1) * 2**20, threads_per_step, shared,
+                                                 self._start, self._done, self._stop, self._errors))
+                           for rank in range(n_workers)]
+        for process in self._processes:
+            process.start()
+        self._closed = False
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+
+    def _exited(self):
+        return [(rank, process.exitcode) for rank, process in enumerate(self._processes)
+                if process.exitcode is not None]
+
+    def _watch(self):
+        ## a worker that was killed never reaches the barriers: break them so nobody waits for it
+        while not self._closed:
+            if self._exited():
+                self._start.abort()
+                self._done.abort()
+                return
+            time.sleep(0.1)
+
+    def _failure(self, exited):
+        try:
+            return self._errors.get(timeout=1)
+        except queue.Empty:
+            pass
+        if exited:
+            return "; ".join(f"worker {rank} exited with code {code}" for rank, code in exited)
+        return f"the workers did not finish a step within {self.timeout} s"
+
+    def _wait(self, barrier):
+        try:
+            barrier.wait(timeout=self.timeout)
+        except threading.BrokenBarrierError:
+            ## the workers that were gone before the others are released below
+            exited = self._exited()
+            self._start.abort()
+            self._done.abort()
+            raise RuntimeError(self._failure(exited)) from None
+
+    def log_density_gradient(self, xb, yb, out=None):
+        """Average log density and gradient over the shards of one global batch."""
+        self._xb.array[...] = xb
+        self._yb.array[...] = yb
+        self._wait(self._start)
+        self._wait(self._done)
+        if out is None:
+            out = np.empty(self._grads.shape[1])
+        np.mean(self._grads.array, axis=0, out=out)
+        return float(self._lps.array.mean()), out
+
+    def close(self):
+        """Stop the workers and give the driver back a private copy of the parameters."""
+        if self._closed:
+            return
+        self._closed = True
+        self._watchdog.join()
+        self._stop.set()
+        try:
+            self._start.wait(timeout=10)
+        except threading.BrokenBarrierError:
+            pass
+        for process in self._processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.driver.theta = self._theta.array.copy()
+        for array in (self._theta, self._grads, self._lps, self._xb, self._yb):
+            array.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
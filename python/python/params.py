@@ -0,0 +1,139 @@
+from collections import namedtuple
+
+import numpy as np
+
+from .stages import get_stage
+
+
+## One parameter of a stage model: its shape as returned by stan_variables()
+## (arrays first, then the vector or matrix dimensions) and where it starts in
+## the flat buffer of a ParameterState.
+ParameterSpec = namedtuple('ParameterSpec', ['name', 'shape', 'offset'])
+
+
+def _stage_shapes(number, V, C, T, H, L):
+    ## (name, shape) in the order of the parameters block of stan/NN-*.stan
+    head_size = C // H if H else None
+    shapes = [('token_embedding', (V, V if number == 1 else C))]
+    if number >= 2:
+        shapes += [('lm_head_multiplier', (V, C)), ('lm_head_offset', (V,))]
+    if number >= 3:
+        shapes += [('position_embedding', (T, C))]
+    if number == 4:
+        shapes += [(name, (C, C)) for name in ('key', 'query', 'value')]
+    elif number >= 5:
+        heads = (L, H) if number >= 10 else (H,)
+        shapes += [(name, heads + (C, head_size)) for name in ('key', 'query', 'value')]
+    layers = (L,) if number >= 10 else ()
+    if number >= 12:
+        shapes += [('sa_proj_multiplier', layers + (C, C)), ('sa_proj_offset', layers + (C,))]
+    if number in (6, 7):
+        shapes += [('feed_forward_multiplier', (C, C)), ('feed_forward_offset', (C,))]
+    elif number >= 8:
+        shapes += [('feed_forward_multiplier', layers + (4 * C, C)),
+                   ('feed_forward_offset', layers + (4 * C,)),
+                   ('feed_forward_proj_multiplier', layers + (C, 4 * C)),
+                   ('feed_forward_proj_offset', layers + (C,))]
+    if number >= 9:
+        shapes += [(name, layers + (C,)) for name in ('ln1_weight', 'ln1_bias', 'ln2_weight', 'ln2_bias')]
+    if number >= 10:
+        shapes += [('ln_f_weight', (C,)), ('ln_f_bias', (C,))]
+    return shapes
+
+
+class ParameterManifest:
+    """Names, shapes and offsets of a stage model's parameters in a flat buffer.
+
+    Each parameter occupies a contiguous, row-major (NumPy order) slice, so
+    `values[spec.offset:...].reshape(spec.shape)` is a view, not a copy.
+    """
+
+    def __init__(self, shapes):
+        self.specs = []
+        offset = 0
+        for name, shape in shapes:
+            shape = tuple(int(n) for n in shape)
+            self.specs.append(ParameterSpec(name, shape, offset))
+            offset += int(np.prod(shape, dtype=np.int64))
+        self.size = offset
+        self._by_name = {spec.name: spec for spec in self.specs}
+
+    @classmethod
+    def for_stage(cls, stage, hyperparameters):
+        """The manifest of a stage for the given hyperparameters (no compiled model needed)."""
+        stage = get_stage(stage)
+        h = hyperparameters
+        return cls(_stage_shapes(int(stage.name[:2]), h['vocab_size'], h.get('n_embed'), h['block_size'],
+                                 h.get('n_head'), h.get('n_layer')))
+
+    @property
+    def names(self):
+        return [spec.name for spec in self.specs]
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def __iter__(self):
+        return iter(self.specs)
+
+    def __len__(self):
+        return len(self.specs)
+
+    def __eq__(self, other):
+        return isinstance(other, ParameterManifest) and [s[:2] for s in self] == [s[:2] for s in other]
+
+    def to_dict(self):
+        return {spec.name: list(spec.shape) for spec in self.specs}
+
+    @classmethod
+    def from_dict(cls, shapes):
+        return cls(shapes.items())
+
+    def constrained_order(self):
+        """Index into the flat buffer for each entry of Stan's constrained parameter vector.
+
+        Stan (CmdStan CSV columns, BridgeStan `param_constrain`) lists each
+        parameter in column-major order; the buffer holds it row-major.
+        """
+        return np.concatenate([spec.offset + np.arange(int(np.prod(spec.shape)), dtype=np.intp)
+                               .reshape(spec.shape).ravel(order='F') for spec in self.specs])
+
+
+class ParameterState:
+    """A stage model's parameters as one contiguous float64 buffer plus its manifest.
+
+    Carrying a state from step to step (or to the inference engine) moves
+    one array; nothing is formatted as text or parsed back. `stan_variables()`
+    gives a name -> array dictionary of views into the buffer, in the same
+    shapes as CmdStanPy's `stan_variables()`.
+    """
+
+    def __init__(self, manifest, values=None):
+        self.manifest = manifest
+        if values is None:
+            values = np.zeros(manifest.size)
+        values = np.asarray(values, dtype=np.float64)
+        if values.shape != (manifest.size,):
+            raise ValueError(f"expecting {manifest.size} parameter values, got shape {values.shape}")
+        self.values = values
+
+    @classmethod
+    def from_stan_variables(cls, manifest, stan_variables):
+        """Pack the parameters out of a `stan_variables()` dictionary; other entries are ignored."""
+        state = cls(manifest)
+        for spec in manifest:
+            value = np.asarray(stan_variables[spec.name], dtype=np.float64)
+            if value.shape != spec.shape:
+                raise ValueError(f"{spec.name}: expecting shape {spec.shape}, got {value.shape}")
+            state[spec.name][...] = value
+        return state
+
+    def __getitem__(self, name):
+        spec = self.manifest[name]
+        return self.values[spec.offset:spec.offset + int(np.prod(spec.shape))].reshape(spec.shape)
+
+    def stan_variables(self):
+        return {spec.name: self[spec.name] for spec in self.manifest}
+
+    def copy(self):
+        return ParameterState(self.manifest, self.values.copy())
@@ -0,0 +1,223 @@
+import argparse
+import json
+import multiprocessing
+from collections import namedtuple
+
+import numpy as np
+
+from .metrics import peak_rss_bytes
+from .params import ParameterManifest
+from .stages import get_stage
+
+
+## Size and cost of one training step of a stage model.
+##   n_parameters:  number of unconstrained parameters
+##   tape_entries:  scalars the reverse-mode autodiff tape holds for one gradient
+##   memory_bytes:  estimated peak memory of the process, from a Calibration
+##   csv_bytes:     size of the CmdStan output CSV of one optimize() call
+##   flops:         floating point operations of one gradient (forward and backward pass)
+Plan = namedtuple('Plan', ['stage', 'hyperparameters', 'n_parameters', 'tape_entries',
+                           'memory_bytes', 'csv_bytes', 'flops'])
+
+## Peak memory ~ overhead_bytes + bytes_per_entry * tape_entries + bytes_per_parameter * n_parameters.
+## The defaults are rough; fit_calibration() / calibrate() replace them with measured values.
+Calibration = namedtuple('Calibration', ['overhead_bytes', 'bytes_per_entry', 'bytes_per_parameter'])
+DEFAULT_CALIBRATION = Calibration(overhead_bytes=100e6, bytes_per_entry=48.0, bytes_per_parameter=80.0)
+
+
+def _step_counts(number, V, B, T, C, H, L):
+    ## (tape entries, forward flops) of one log density evaluation, counting every
+    ## intermediate the stage program builds (see stan/NN-*.stan)
+    N = B * T
+    if number == 1:
+        return N * V, 4 * N * V
+    layers = L if number >= 10 else 1
+    F = 4 * C if number >= 8 else C
+    entries = N * C * (1 if number == 2 else 2)              # embeddings
+    flops = 0
+    if number == 4:
+        entries += B * (6 * T * C + 3 * T * T) + N * C       # self_attention + to_rows
+        flops += 6 * N * C * C + 4 * N * T * C
+    elif number >= 5:
+        attention = 3 * C * C + 7 * N * C + B * H * (6 if number >= 11 else 5) * T * T
+        if number >= 11:
+            attention += N * C                                # dropout
+        if number >= 12:
+            attention += 2 * N * C                            # projection
+        feed_forward = 3 * N * F + (2 * N * C if number >= 8 else 0) + (N * C if number >= 11 else 0)
+        layer_norm = 4 * N * C + 4 * N
+        per_layer = attention + feed_forward
+        if number >= 7:
+            per_layer += 2 * N * C                            # skip connections
+        if number >= 9:
+            per_layer += 2 * layer_norm
+        entries += layers * per_layer + (layer_norm if number >= 10 else 0)
+        per_layer_flops = 6 * N * C * C + 4 * N * T * C + 2 * N * C * F * (2 if number >= 8 else 1)
+        if number >= 12:
+            per_layer_flops += 2 * N * C * C
+        flops += layers * per_layer_flops
+    ## lm_head + categorical_logit_glm: the head is transposed and the GLM keeps the
+    ## partials of x and beta
+    entries += N * C + 2 * C * V + V
+    flops += 2 * N * C * V + 5 * N * V
+    return entries, flops
+
+
+def _csv_bytes(manifest, max_new_tokens, chars_per_value=12):
+    ## header: lp__, one column per parameter entry (name.i.j...), loss, loss_validation,
+    ## new_tokens.n; then one row of values
+    columns = 1 + manifest.size + 2 + max_new_tokens
+    header = len('lp__,loss,loss_validation,') + sum(len(f'new_tokens.{n},') for n in range(1, max_new_tokens + 1))
+    for spec in manifest:
+        count = int(np.prod(spec.shape))
+        header += count * (len(spec.name) + 1)
+        for dim in spec.shape:
+            digits = sum(len(str(i)) + 1 for i in range(1, dim + 1))
+            header += count // dim * digits
+    return header + columns * chars_per_value
+
+
+def plan(stage, hyperparameters, calibration=DEFAULT_CALIBRATION, max_new_tokens=500):
+    """Estimate parameter count, autodiff memory, CSV size and FLOPs of one training step.
+
+    `hyperparameters` holds the stage's scalars (`vocab_size`, `batch_size`,
+    `block_size`, `n_embed`, `n_head`, `n_layer`); nothing is compiled or run.
+    """
+    stage = get_stage(stage)
+    h = hyperparameters
+    manifest = ParameterManifest.for_stage(stage, h)
+    entries, flops = _step_counts(int(stage.name[:2]), h['vocab_size'], h['batch_size'], h['block_size'],
+                                  h.get('n_embed'), h.get('n_head'), h.get('n_layer'))
+    ## the parameters are on the tape too
+    entries += manifest.size
+    memory = (calibration.overhead_bytes + calibration.bytes_per_entry * entries
+              + calibration.bytes_per_parameter * manifest.size)
+    return Plan(stage.name, {name: h[name] for name in stage.hyperparameters}, manifest.size,
+                entries, int(memory), _csv_bytes(manifest, max_new_tokens), 3 * flops)
+
+
+def largest(stage, hyperparameters, memory_limit, vary='batch_size', calibration=DEFAULT_CALIBRATION,
+            maximum=1 << 16):
+    """The hyperparameters with the largest `vary` ('batch_size' or 'block_size') that fit in `memory_limit` bytes.
+
+    Returns None if even a value of 1 does not fit.
+    """
+    if vary not in ('batch_size', 'block_size'):
+        raise ValueError(f"can only vary batch_size or block_size, not {vary!r}")
+    fits = lambda n: plan(stage, dict(hyperparameters, **{vary: n}), calibration).memory_bytes <= memory_limit
+    if not fits(1):
+        return None
+    ## memory grows with either size: double until it no longer fits, then bisect
+    low, high = 1, 2
+    while high <= maximum and fits(high):
+        low, high = high, 2 * high
+    high = min(high, maximum + 1)
+    while high - low > 1:
+        middle = (low + high) // 2
+        low, high = (middle, high) if fits(middle) else (low, middle)
+    return dict(hyperparameters, **{vary: low})
+
+
+def _measure(stage, hyperparameters, model_lib, queue):
+    from .driver import StageDriver
+    driver = StageDriver(stage, hyperparameters, model_lib=model_lib)
+    rng = np.random.default_rng(0)
+    shape = (hyperparameters['batch_size'], hyperparameters['block_size'])
+    xb = rng.integers(1, hyperparameters['vocab_size'] + 1, shape)
+    driver.log_density_gradient(driver.dump_data(xb, xb))
+    queue.put(peak_rss_bytes())
+
+
+def measure_peak_memory(stage, hyperparameters, model_lib):
+    """Peak resident memory (bytes) of a fresh process that evaluates one gradient with the driver."""
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(get_stage(stage).name, hyperparameters,
+                                                     str(model_lib), queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"measuring stage {stage} with {hyperparameters} failed "
+                           f"(exit code {process.exitcode})")
+    return queue.get()
+
+
+def fit_calibration(measurements):
+    """Least-squares Calibration from (stage, hyperparameters, peak_bytes) measurements.
+
+    Three or more measurements with different parameter counts fit all
+    three coefficients; with fewer, only `bytes_per_entry` is fitted and the
+    other two keep their defaults.
+    """
+    plans = [plan(stage, h, Calibration(0.0, 1.0, 0.0)) for stage, h, _ in measurements]
+    peaks = np.array([peak for _, _, peak in measurements], dtype=np.float64)
+    entries = np.array([p.tape_entries for p in plans], dtype=np.float64)
+    parameters = np.array([p.n_parameters for p in plans], dtype=np.float64)
+    if len(measurements) >= 3 and len(set(parameters)) > 1:
+        design = np.column_stack([np.ones_like(entries), entries, parameters])
+        overhead, per_entry, per_parameter = np.linalg.lstsq(design, peaks, rcond=None)[0]
+        return Calibration(float(max(overhead, 0.0)), float(max(per_entry, 0.0)), float(max(per_parameter, 0.0)))
+    d = DEFAULT_CALIBRATION
+    rest = peaks - d.overhead_bytes - d.bytes_per_parameter * parameters
+    return d._replace(bytes_per_entry=float(max(rest @ entries / (entries @ entries), 0.0)))
+
+
+def calibrate(stage, configurations, model_lib):
+    """Measure each hyperparameter set of `configurations` on this machine and fit a Calibration."""
+    return fit_calibration([(stage, h, measure_peak_memory(stage, h, model_lib)) for h in configurations])
+
+
+def save_calibration(path, calibration):
+    with open(path, 'w') as f:
+        json.dump(calibration._asdict(), f, indent=2)
+
+
+def load_calibration(path):
+    with open(path) as f:
+        return Calibration(**json.load(f))
+
+
+def _size(text):
+    ## '16GB', '512MB', '2e9' -> bytes
+    units = {'KB': 1e3, 'MB': 1e6, 'GB': 1e9, 'TB': 1e12}
+    text = text.strip().upper()
+    for unit, factor in units.items():
+        if text.endswith(unit):
+            return float(text[:-len(unit)]) * factor
+    return float(text)
+
+
+def format_plan(p):
+    gb = lambda n: f"{n / 1e9:.2f} GB"
+    return "\n".join([
+        f"stage {p.stage}: " + ", ".join(f"{k}={v}" for k, v in p.hyperparameters.items()),
+        f"  parameters       {p.n_parameters:,}",
+        f"  autodiff tape    {p.tape_entries:,} entries",
+        f"  peak memory      {gb(p.memory_bytes)}",
+        f"  output CSV       {p.csv_bytes / 1e6:.1f} MB per optimize() call",
+        f"  FLOPs per step   {p.flops / 1e9:.2f} GFLOP",
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Estimate the cost of a training step of a stage model.")
+    parser.add_argument('stage')
+    parser.add_argument('--vocab-size', type=int, default=65)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--block-size', type=int, default=8)
+    parser.add_argument('--n-embed', type=int, default=32)
+    parser.add_argument('--n-head', type=int, default=2)
+    parser.add_argument('--n-layer', type=int, default=2)
+    parser.add_argument('--dropout', type=float, default=0.2)
+    parser.add_argument('--memory', type=_size, help="memory ceiling, e.g. 16GB: report the largest batch_size and block_size that fit")
+    parser.add_argument('--calibration', help="JSON file written by save_calibration()")
+    args = parser.parse_args()
+
+    calibration = load_calibration(args.calibration) if args.calibration else DEFAULT_CALIBRATION
+    hyperparameters = {name: getattr(args, name) for name in
+                       ('vocab_size', 'batch_size', 'block_size', 'n_embed', 'n_head', 'n_layer', 'dropout')}
+    print(format_plan(plan(args.stage, hyperparameters, calibration)))
+    if args.memory:
+        for vary in ('batch_size', 'block_size'):
+            best = largest(args.stage, hyperparameters, args.memory, vary, calibration)
+            print(f"  largest {vary:<10} {best[vary] if best else 'none'} fits in {args.memory / 1e9:.1f} GB")
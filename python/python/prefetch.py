@@ -0,0 +1,134 @@
+import os
+import queue
+import tempfile
+import threading
+from contextlib import nullcontext
+
+import cmdstanpy
+
+
+class Prefetcher:
+    """Run `produce()` in a background thread, keeping up to `depth` results ready.
+
+    The worker fills a bounded queue while the caller is busy with the model
+    (a CmdStan subprocess or a BridgeStan call, neither of which holds the
+    GIL), so the next input is already built when it is asked for. An
+    exception in `produce` is re-raised by the next `get()`; `produce`
+    raising StopIteration ends the stream.
+
+        batches = Prefetcher(lambda: driver.dump_data(*get_batch()))
+        for step in range(max_iters):
+            lp, grad = driver.log_density_gradient(batches.get())
+        batches.close()
+    """
+
+    _done = object()
+
+    def __init__(self, produce, depth=2):
+        if depth < 1:
+            raise ValueError(f"depth must be at least 1, got {depth}")
+        self.produce = produce
+        self.depth = depth
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                item = (self.produce(), None)
+            except StopIteration:
+                item = (self._done, None)
+            except BaseException as e:
+                item = (self._done, e)
+            ## block while the queue is full, but wake up to notice close()
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[0] is self._done:
+                return
+
+    def get(self):
+        """The next prepared item; raises StopIteration at the end of the stream."""
+        if self._finished:
+            raise StopIteration
+        item, error = self._queue.get()
+        if item is self._done:
+            self._finished = True
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def __iter__(self):
+        return self
+
+    __next__ = get
+
+    def close(self):
+        """Stop the worker and drop whatever it had prepared."""
+        self._stop.set()
+        self._thread.join()
+        self._finished = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StanDataFiles(Prefetcher):
+    """Prefetch minibatches for CmdStan as ready-to-use JSON data files.
+
+    Each item is the path of a JSON file holding `data` with `xb, yb`
+    replaced by a fresh `get_batch()` (and `xb_val, yb_val` by
+    `get_val_batch()`, if given). Pass it straight to `model.optimize(data=...)`
+    so cmdstanpy does not serialize the batch itself. Files are written to a
+    ring of `depth + 2` slots in `directory` (a temporary directory by
+    default), so a file is only rewritten once the step that used it is over.
+    With `metrics` (a `python.metrics.MetricsLog`) the time spent drawing
+    and writing each batch is logged as the `sample` and `serialize` phases.
+
+        batches = StanDataFiles(data, lambda: get_data_batch(data_train, batch_size, block_size),
+                                lambda: get_data_batch(data_val, batch_size, block_size))
+        for step in range(1000):
+            optimum = model.optimize(data=batches.get(), ...)
+        batches.close()
+    """
+
+    def __init__(self, data, get_batch, get_val_batch=None, depth=2, directory=None, metrics=None):
+        self.data = dict(data)
+        self.metrics = metrics
+        self.get_batch = get_batch
+        self.get_val_batch = get_val_batch
+        self._tmpdir = tempfile.TemporaryDirectory(prefix='stan-batches-') if directory is None else None
+        self.directory = self._tmpdir.name if directory is None else directory
+        self._n_slots = depth + 2
+        self._count = 0
+        super().__init__(self._write_next, depth)
+
+    def _phase(self, name):
+        return self.metrics.phase(name) if self.metrics is not None else nullcontext()
+
+    def _write_next(self):
+        data = self.data
+        with self._phase('sample'):
+            data['xb'], data['yb'] = self.get_batch()
+            if self.get_val_batch is not None:
+                data['xb_val'], data['yb_val'] = self.get_val_batch()
+        path = os.path.join(self.directory, f'batch-{self._count % self._n_slots}.json')
+        self._count += 1
+        with self._phase('serialize'):
+            cmdstanpy.write_stan_json(path, data)
+        return path
+
+    def close(self):
+        super().close()
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
@@ -0,0 +1,98 @@
+import csv
+import sys
+
+from .stages import get_stage
+
+
+## numeric columns of a CmdStan profile CSV (one row per profile name and thread)
+PROFILE_COLUMNS = ('total_time', 'forward_time', 'reverse_time', 'chain_stack', 'no_chain_stack',
+                   'autodiff_calls', 'no_autodiff_calls')
+
+## profiles that enclose others: reported, but left out of the shares
+CONTAINERS = ('validation',)
+
+
+def read_profile(path):
+    """The rows of a CmdStan profile CSV, with times in seconds and counts as ints."""
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for column in PROFILE_COLUMNS:
+            row[column] = (float if column.endswith('_time') else int)(row[column])
+    return rows
+
+
+class ProfileCollector:
+    """Sum the `profile` blocks of the stage models over many CmdStan runs.
+
+    Stages 04 to 12 time each sublayer of the forward pass (embedding,
+    layer_norm, attention, feed_forward, lm_head) plus the validation loss
+    and generation. Run `optimize(..., save_profile=True)` and pass each
+    fit (or profile CSV path) to `add()`:
+
+        profiles = ProfileCollector()
+        for step in range(1000):
+            fit = model.optimize(data=..., save_profile=True, ...)
+            profiles.add('07', fit)
+        print(profiles.format_report())
+
+    Profiles run with and without autodiff: the training gradient records
+    both a forward and a reverse pass; the validation loss (in generated
+    quantities) only a forward pass, counted in `no_autodiff_calls`.
+    `chain_stack` and `no_chain_stack` count the entries allocated on the
+    autodiff stacks.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.runs = {}
+
+    def add(self, stage, source, run=None):
+        """Add one CmdStan run: a fit saved with `save_profile=True`, or a profile CSV path.
+
+        Runs are grouped by `run` (the stage name unless given) in the report.
+        """
+        stage = run or get_stage(stage).name
+        paths = [source] if isinstance(source, str) else [p for p in source.runset.profile_files if p]
+        if not paths:
+            raise ValueError("no profile file; run CmdStan with save_profile=True")
+        totals = self.totals.setdefault(stage, {})
+        for path in paths:
+            for row in read_profile(path):
+                ## one row per thread: add them up
+                entry = totals.setdefault(row['name'], dict.fromkeys(PROFILE_COLUMNS, 0))
+                for column in PROFILE_COLUMNS:
+                    entry[column] += row[column]
+        self.runs[stage] = self.runs.get(stage, 0) + 1
+
+    def report(self):
+        """Per run, its sublayers ranked by total time, with each one's share of the run."""
+        report = {}
+        for stage, totals in self.totals.items():
+            time = sum(entry['total_time'] for name, entry in totals.items() if name not in CONTAINERS)
+            rows = [dict(entry, name=name, share=entry['total_time'] / time if time and name not in CONTAINERS else None)
+                    for name, entry in totals.items()]
+            report[stage] = {'runs': self.runs[stage], 'total_time': time,
+                             'sublayers': sorted(rows, key=lambda row: -row['total_time'])}
+        return report
+
+    def format_report(self):
+        lines = []
+        for stage, s in self.report().items():
+            lines.append(f"{stage}: {s['runs']} runs, {s['total_time']:.2f} s in profiled sublayers")
+            lines.append(f"  {'':<14}{'total s':>10}{'share':>8}{'forward s':>11}{'reverse s':>11}"
+                         f"{'stack':>14}{'ad calls':>10}{'no-ad calls':>13}")
+            for row in s['sublayers']:
+                share = f"{100 * row['share']:6.1f}%" if row['share'] is not None else f"{'':>7}"
+                lines.append(f"  {row['name']:<14}{row['total_time']:10.3f} {share}{row['forward_time']:11.3f}"
+                             f"{row['reverse_time']:11.3f}{row['chain_stack'] + row['no_chain_stack']:14,}"
+                             f"{row['autodiff_calls']:10,}{row['no_autodiff_calls']:13,}")
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    ## python -m python.profiling STAGE profile.csv [profile.csv ...]
+    profiles = ProfileCollector()
+    for path in sys.argv[2:]:
+        profiles.add(sys.argv[1], path)
+    print(profiles.format_report())
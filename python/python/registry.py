@@ -0,0 +1,174 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .stages import STAGES, STAN_DIR, get_stage, stan_file
+
+
+MODEL_DIR = os.path.abspath(os.path.join(STAN_DIR, '..', 'build', 'models'))
+
+## a C++ compile of a stage model takes 1-2 GB of memory: run at most this many at once by default
+COMPILE_JOBS = 4
+
+
+def _toolchain(kind):
+    ## a model built by another CmdStan or BridgeStan is a different model
+    if kind == 'cmdstan':
+        import cmdstanpy
+        try:
+            return cmdstanpy.cmdstan_path()
+        except ValueError:
+            return None
+    import bridgestan
+    return [bridgestan.__version__, os.environ.get('BRIDGESTAN')]
+
+
+class ModelRegistry:
+    """Compiled stage models, keyed by a hash of the Stan source and the compiler options.
+
+    Each build lives in its own directory, `<directory>/<stage>-<key>/`, so
+    models compiled with different options (STAN_THREADS, -O3, stanc --O1, ...)
+    sit side by side instead of overwriting each other. The directory is
+    shared: any script (or process) asking for the same source and options
+    gets the same executable, and startup only hashes the source when nothing
+    has changed.
+
+    Models compile lazily, on the first `model()` / `library()` call for a
+    key, or ahead of time with `compile()`:
+
+        models = ModelRegistry()
+        models.compile()                  # every stage, several compilers at once
+        model_07 = models.model('07')     # a CmdStanModel, no compiler run
+        driver = StageDriver('07', hyperparameters,
+                             model_lib=models.library('07', make_args=['STAN_THREADS=true']))
+
+    A build is written to a temporary directory and renamed into place, so
+    concurrent builds of one key never leave a half-written model behind.
+    An entry whose executable or library was deleted is built again.
+    Only the options passed in are part of the key; after editing
+    `make/local` or upgrading the compiler, call with `force=True`.
+    """
+
+    def __init__(self, directory=MODEL_DIR):
+        self.directory = directory
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def key(self, stage, options=None, kind='cmdstan'):
+        """Hex digest of the stage's Stan source, the build options and the toolchain."""
+        stage = get_stage(stage)
+        with open(stan_file(stage), 'rb') as f:
+            source = hashlib.sha256(f.read()).hexdigest()
+        description = {'kind': kind, 'stage': stage.name, 'source': source,
+                       'options': options or {}, 'toolchain': _toolchain(kind)}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def _build_dir(self, stage, key):
+        return os.path.join(self.directory, f'{get_stage(stage).name}-{key}')
+
+    def _artifact(self, stage, options, kind, build, force):
+        ## path of the executable (cmdstan) or shared library (bridgestan) of a build
+        stage = get_stage(stage)
+        key = self.key(stage, options, kind)
+        final = self._build_dir(stage, key)
+        manifest = os.path.join(final, 'model.json')
+        if not force:
+            try:
+                with open(manifest) as f:
+                    cached = os.path.join(final, json.load(f)['artifact'])
+            except (OSError, ValueError, KeyError):
+                cached = None
+            if cached is not None and os.path.isfile(cached):
+                return cached
+        ## forced, never built, or an entry that was deleted in part: build it again
+        shutil.rmtree(final, ignore_errors=True)
+
+        os.makedirs(self.directory, exist_ok=True)
+        work = tempfile.mkdtemp(prefix=f'.{stage.name}-{key}-', dir=self.directory)
+        try:
+            source = os.path.join(work, stage.name + '.stan')
+            shutil.copyfile(stan_file(stage), source)
+            artifact = os.path.basename(str(build(source)))
+            with open(os.path.join(work, 'model.json'), 'w') as f:
+                json.dump({'stage': stage.name, 'kind': kind, 'key': key, 'options': options or {},
+                           'artifact': artifact}, f, indent=2, default=str)
+            try:
+                os.rename(work, final)
+            except OSError:
+                ## another process finished the same build first: use theirs
+                if not os.path.exists(manifest):
+                    raise
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        return os.path.join(final, artifact)
+
+    def executable(self, stage, stanc_options=None, cpp_options=None, force=False):
+        """Path of the CmdStan executable of a stage, compiled first if needed."""
+        from cmdstanpy.compilation import compile_stan_file
+        options = {'stanc_options': stanc_options or {}, 'cpp_options': cpp_options or {}}
+        return self._artifact(stage, options, 'cmdstan',
+                              lambda source: compile_stan_file(source, stanc_options=stanc_options,
+                                                               cpp_options=cpp_options),
+                              force)
+
+    def model(self, stage, stanc_options=None, cpp_options=None, force=False):
+        """The stage's CmdStanModel, compiled on first use."""
+        from cmdstanpy import CmdStanModel
+        options = {'stanc_options': stanc_options or {}, 'cpp_options': cpp_options or {}}
+        key = (get_stage(stage).name, json.dumps(options, sort_keys=True, default=str))
+        with self._lock:
+            model = None if force else self._models.get(key)
+        if model is None:
+            exe = self.executable(stage, stanc_options, cpp_options, force)
+            ## from the executable alone: no stanc run to inspect the source
+            model = CmdStanModel(exe_file=exe)
+            with self._lock:
+                self._models[key] = model
+        return model
+
+    def library(self, stage, stanc_args=(), make_args=(), force=False):
+        """Path of the BridgeStan shared library of a stage (for StageDriver), compiled first if needed."""
+        import bridgestan
+        options = {'stanc_args': list(stanc_args), 'make_args': list(make_args)}
+        return self._artifact(stage, options, 'bridgestan',
+                              lambda source: bridgestan.compile_model(source, stanc_args=list(stanc_args),
+                                                                      make_args=list(make_args)),
+                              force)
+
+    def compile(self, stages=None, jobs=None, stanc_options=None, cpp_options=None, force=False):
+        """Compile the CmdStan executables of `stages` (default: all twelve) ahead of time.
+
+        Up to `jobs` (default: COMPILE_JOBS, or fewer cores) compilers run at
+        once; each is its own process, so threads are enough to drive them.
+        Returns {stage name: executable path}.
+        """
+        stages = [get_stage(stage) for stage in (stages or STAGES)]
+        jobs = jobs or min(COMPILE_JOBS, os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            paths = pool.map(lambda stage: self.executable(stage, stanc_options, cpp_options, force), stages)
+            return {stage.name: path for stage, path in zip(stages, paths)}
+
+    def builds(self):
+        """The manifests of every build in the registry directory."""
+        builds = []
+        if os.path.isdir(self.directory):
+            for name in sorted(os.listdir(self.directory)):
+                manifest = os.path.join(self.directory, name, 'model.json')
+                if not name.startswith('.') and os.path.exists(manifest):
+                    with open(manifest) as f:
+                        builds.append(json.load(f))
+        return builds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile the stage models ahead of time, in parallel.")
+    parser.add_argument('stages', nargs='*', help="default: all twelve")
+    parser.add_argument('--jobs', '-j', type=int, help=f"compilers at once (default: {COMPILE_JOBS})")
+    args = parser.parse_args()
+    for name, path in ModelRegistry().compile(args.stages or None, args.jobs).items():
+        print(f"{name:<32}{path}")
@@ -0,0 +1,362 @@
+import argparse
+import json
+import math
+import os
+import queue
+import select
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from .checkpoint import load_checkpoint
+from .inference import InferenceEngine
+from .streaming import TextStream
+from .tokenizer import Tokenizer
+
+
+class Generation:
+    """One queued or running request: its settings, and the pieces of text it produced.
+
+    `events` receives ('text', piece) for every piece and, last,
+    ('done', finish_reason) where finish_reason is 'stop', 'length',
+    'cancelled' or an error message.
+    """
+
+    def __init__(self, context, max_new_tokens, temperature, top_k, text, seed):
+        self.context = context
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.text = text
+        self.rng = np.random.default_rng(seed)
+        self.events = queue.Queue()
+        self.tokens = 0
+        self.cancelled = False
+        self.submitted = time.perf_counter()
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class BatchScheduler:
+    """Continuous batching of generation requests over one InferenceEngine.
+
+    A single thread owns the engine. Every decode step it admits queued
+    requests into free slots (up to `max_batch_size` running at once),
+    samples one token for every running request, hands out the decoded
+    text, retires the requests that are done and runs one batched forward
+    pass for all the others. The batch grows and shrinks step by step, so a
+    new request never waits for the ones already running to finish.
+
+    Each request samples from its own random generator, so with the same
+    seed it produces what `stream_text()` does.
+    """
+
+    def __init__(self, engine, tokenizer, max_batch_size=32):
+        self.engine = engine
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.block_size = engine.block_size or 1
+        self._cache = engine.new_cache(max_batch_size)
+        self._windows = np.ones((max_batch_size, self.block_size), dtype=np.intp)
+        self._lengths = np.zeros(max_batch_size, dtype=np.intp)
+        self._logits = np.zeros((max_batch_size, engine.vocab_size))
+        self._slots = [None] * max_batch_size
+        self._queue = deque()
+        self._wake = threading.Condition()
+        self._closed = False
+        self.steps = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt=None, max_new_tokens=500, temperature=1.0, top_k=None, stop=None, seed=None):
+        """Queue a request; returns its Generation, whose `events` the caller reads."""
+        if prompt is not None and not isinstance(prompt, str):
+            raise ValueError(f"prompt must be a string or null, got {type(prompt).__name__}")
+        if max_new_tokens < 1:
+            raise ValueError(f"max_new_tokens must be at least 1, got {max_new_tokens}")
+        if not math.isfinite(temperature) or temperature < 0:
+            raise ValueError(f"temperature must be finite and not negative, got {temperature}")
+        if top_k is not None and top_k < 1:
+            raise ValueError(f"top_k must be at least 1 or null, got {top_k}")
+        context = self.tokenizer.encode(prompt) if prompt else np.ones(1, dtype=np.intp)
+        generation = Generation(np.asarray(context, dtype=np.intp), max_new_tokens, temperature, top_k,
+                                TextStream(self.tokenizer, stop), seed)
+        with self._wake:
+            if self._closed:
+                raise RuntimeError("scheduler is closed")
+            self._queue.append(generation)
+            self._wake.notify()
+        return generation
+
+    def stats(self):
+        with self._wake:
+            return {'running': sum(g is not None for g in self._slots), 'queued': len(self._queue),
+                    'max_batch_size': self.max_batch_size, 'steps': self.steps}
+
+    def close(self):
+        with self._wake:
+            self._closed = True
+            self._wake.notify()
+        self._thread.join()
+
+    def _admit(self):
+        ## prefill each new request's prompt into a free slot of the cache
+        while True:
+            with self._wake:
+                if not self._queue or None not in self._slots:
+                    return
+                generation = self._queue.popleft()
+            if generation.cancelled:
+                generation.events.put(('done', 'cancelled'))
+                continue
+            slot = self._slots.index(None)
+            tail = generation.context[-self.block_size:]
+            self._windows[slot, :len(tail)] = tail
+            self._lengths[slot] = len(tail)
+            try:
+                self._logits[slot] = self.engine.forward(tail[None], 0, self._cache, [slot])[0, -1]
+            except Exception as e:
+                ## the slot stays free; only this request fails
+                generation.events.put(('done', f"error: {e!r}"))
+                continue
+            self._slots[slot] = generation
+
+    def _finish(self, slot, reason):
+        generation = self._slots[slot]
+        piece = generation.text.flush()
+        if piece:
+            generation.events.put(('text', piece))
+        generation.events.put(('done', reason))
+        self._slots[slot] = None
+
+    def _step(self):
+        active = [slot for slot, g in enumerate(self._slots) if g is not None]
+        new_tokens = np.empty(self.max_batch_size, dtype=np.intp)
+        running = []
+        for slot in active:
+            generation = self._slots[slot]
+            if generation.cancelled:
+                self._finish(slot, 'cancelled')
+                continue
+            token = int(self.engine.sample(self._logits[slot:slot + 1], generation.rng,
+                                           generation.temperature, generation.top_k)[0])
+            generation.tokens += 1
+            piece = generation.text.push(token)
+            if piece:
+                generation.events.put(('text', piece))
+            if generation.text.stopped:
+                self._finish(slot, 'stop')
+            elif generation.tokens >= generation.max_new_tokens:
+                self._finish(slot, 'length')
+            else:
+                new_tokens[slot] = token
+                running.append(slot)
+        self.steps += 1
+        if not running:
+            return
+
+        ## the same two batched passes as InferenceEngine.decode(): windows that still
+        ## grow go through the cache one token each, full windows slide and are recomputed
+        rows = np.array(running)
+        lengths, windows = self._lengths, self._windows
+        growing = rows[lengths[rows] < self.block_size]
+        sliding = rows[lengths[rows] >= self.block_size]
+        windows[growing, lengths[growing]] = new_tokens[growing]
+        lengths[growing] += 1
+        windows[sliding, :-1] = windows[sliding, 1:]
+        windows[sliding, -1] = new_tokens[sliding]
+        if len(growing):
+            self._logits[growing] = self.engine.forward(new_tokens[growing, None], lengths[growing] - 1,
+                                                        self._cache, growing)[:, -1]
+        if len(sliding):
+            self._logits[sliding] = self.engine.forward(windows[sliding], 0, self._cache, sliding)[:, -1]
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._closed and not self._queue and all(g is None for g in self._slots):
+                    self._wake.wait()
+                if self._closed:
+                    break
+            try:
+                self._admit()
+                self._step()
+            except Exception as e:
+                ## fail the requests in flight, keep serving new ones
+                for slot, generation in enumerate(self._slots):
+                    if generation is not None:
+                        self._finish(slot, f"error: {e!r}")
+        for slot, generation in enumerate(self._slots):
+            if generation is not None:
+                self._finish(slot, 'cancelled')
+        with self._wake:
+            for generation in self._queue:
+                generation.events.put(('done', 'cancelled'))
+            self._queue.clear()
+
+
+def load_model(path, max_batch_size=32):
+    """A BatchScheduler over the checkpoint at `path` (written by save_checkpoint)."""
+    checkpoint = load_checkpoint(path)
+    engine = InferenceEngine(checkpoint.parameters, checkpoint.stage)
+    return BatchScheduler(engine, Tokenizer(checkpoint.vocabulary), max_batch_size)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """HTTP API of the server.
+
+    GET  /health     the loaded models, with running and queued requests
+    POST /generate   JSON body: prompt, max_new_tokens (500), temperature (1.0), top_k,
+                     stop (string or list), seed, model (default: the first loaded) and
+                     stream (false). With stream, the response is chunked, one JSON
+                     object per line: {"text": ...} per piece, then
+                     {"done": true, "finish_reason": ..., "tokens": ...}. Without,
+                     one JSON object with the whole text. A body that is not a JSON
+                     object, a prompt that is not a string, max_new_tokens < 1, a
+                     negative or non-finite temperature or top_k < 1 get 400. A
+                     client that disconnects cancels its request, streamed or not.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        ## Unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _client_gone(self):
+        ## a closed connection reads as end of file; a client that is still there sends nothing
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and self.connection.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send_json(404, {'error': f"no such path {self.path}"})
+        self._send_json(200, {'models': {name: dict(scheduler.stats(), stage=scheduler.engine.stage.name)
+                                         for name, scheduler in self.server.models.items()}})
+
+    def do_POST(self):
+        if self.path != '/generate':
+            return self._send_json(404, {'error': f"no such path {self.path}"})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(request, dict):
+                raise TypeError(f"the body must be a JSON object, got {type(request).__name__}")
+            name = request.get('model', next(iter(self.server.models)))
+            scheduler = self.server.models[name]
+            top_k = request.get('top_k')
+            generation = scheduler.submit(request.get('prompt'), int(request.get('max_new_tokens', 500)),
+                                          float(request.get('temperature', 1.0)),
+                                          None if top_k is None else int(top_k),
+                                          request.get('stop'), request.get('seed'))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send_json(400, {'error': f"bad request: {e!r}"})
+
+        if not request.get('stream'):
+            pieces = []
+            checked = time.perf_counter()
+            while True:
+                try:
+                    kind, value = generation.events.get(timeout=0.1)
+                except queue.Empty:
+                    kind = None
+                if time.perf_counter() - checked > 0.1:
+                    checked = time.perf_counter()
+                    if self._client_gone():
+                        ## nobody is waiting for the text: free its slot
+                        generation.cancel()
+                        self.close_connection = True
+                        return
+                if kind == 'done':
+                    break
+                if kind is not None:
+                    pieces.append(value)
+            return self._send_json(200, {'text': ''.join(pieces), 'finish_reason': value,
+                                         'tokens': generation.tokens,
+                                         'seconds': time.perf_counter() - generation.submitted})
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            while True:
+                kind, value = generation.events.get()
+                line = {'text': value} if kind == 'text' else {'done': True, 'finish_reason': value,
+                                                               'tokens': generation.tokens}
+                data = (json.dumps(line) + '\n').encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+                if kind == 'done':
+                    break
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            ## the client went away: free its slot
+            generation.cancel()
+            self.close_connection = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+
+
+def make_server(models, host='127.0.0.1', port=8000, unix_socket=None, verbose=False):
+    """An HTTP server (TCP, or on `unix_socket`) for {name: BatchScheduler}; call serve_forever()."""
+    if unix_socket:
+        server = UnixHTTPServer(unix_socket, Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    server.models = models
+    server.verbose = verbose
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve text generation from saved checkpoints.")
+    parser.add_argument('checkpoints', nargs='+', help="checkpoint directories; requests pick one by directory name")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--unix-socket')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    models = {os.path.basename(os.path.normpath(path)): load_model(path, args.max_batch_size)
+              for path in args.checkpoints}
+    server = make_server(models, args.host, args.port, args.unix_socket, args.verbose)
+    print(f"serving {', '.join(models)} on {args.unix_socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for scheduler in models.values():
+            scheduler.close()
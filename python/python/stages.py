@@ -0,0 +1,68 @@
+import os
+from collections import namedtuple
+
+
+STAN_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'stan'))
+
+## A stage is one of the Stan programs in stan/; each one adds a piece of the GPT.
+##   name:            file name without the .stan suffix
+##   hyperparameters: the scalar entries of the data block (besides the batches and max_new_tokens)
+Stage = namedtuple('Stage', ['name', 'hyperparameters'])
+
+_BIGRAM = ('vocab_size', 'batch_size', 'block_size')
+_EMBED = _BIGRAM + ('n_embed',)
+_HEAD = _EMBED + ('n_head',)
+_LAYER = _HEAD + ('n_layer',)
+_DROPOUT = _LAYER + ('dropout',)
+
+STAGES = {
+    '01': Stage('01-bigram', _BIGRAM),
+    '02': Stage('02-different-embedding-size', _EMBED),
+    '03': Stage('03-positional-encoding', _EMBED),
+    '04': Stage('04-self-attention', _EMBED),
+    '05': Stage('05-multi-headed-self-attention', _HEAD),
+    '06': Stage('06-feed-forward', _HEAD),
+    '07': Stage('07-skip-connections', _HEAD),
+    '08': Stage('08-larger-feed-forward-layer', _HEAD),
+    '09': Stage('09-layer-norm', _HEAD),
+    '10': Stage('10-blocks', _LAYER),
+    '11': Stage('11-dropout', _DROPOUT),
+    '12': Stage('12-final', _DROPOUT),
+}
+
+
+def get_stage(stage):
+    """Look up a stage by id ('07', 7) or by name ('07-skip-connections')."""
+    if isinstance(stage, Stage):
+        return stage
+    key = str(stage)
+    if key.isdigit():
+        key = key.zfill(2)
+    key = key[:2]
+    if key not in STAGES:
+        raise ValueError(f"unknown stage {stage!r}; expecting one of {', '.join(STAGES)}")
+    return STAGES[key]
+
+
+def stan_file(stage):
+    return os.path.join(STAN_DIR, get_stage(stage).name + '.stan')
+
+
+def stage_data(stage, hyperparameters, xb, yb, xb_val=None, yb_val=None, max_new_tokens=0):
+    """Build the data dictionary for a stage model.
+
+    Only the hyperparameters the stage declares are kept, so one dictionary
+    of settings can be shared across stages. The validation batch defaults to
+    the training batch; it is only read by the generated quantities block.
+    """
+    stage = get_stage(stage)
+    missing = [name for name in stage.hyperparameters if name not in hyperparameters]
+    if missing:
+        raise ValueError(f"stage {stage.name} needs hyperparameters: {', '.join(missing)}")
+    data = {name: hyperparameters[name] for name in stage.hyperparameters}
+    data['xb'] = xb
+    data['yb'] = yb
+    data['xb_val'] = xb if xb_val is None else xb_val
+    data['yb_val'] = yb if yb_val is None else yb_val
+    data['max_new_tokens'] = max_new_tokens
+    return data
@@ -0,0 +1,109 @@
+import asyncio
+
+import numpy as np
+
+
+def stream_tokens(engine, context=(1,), max_new_tokens=500, seed=None, rng=None, temperature=1.0, top_k=None):
+    """Yield each new 1-indexed token of an InferenceEngine as soon as it is sampled.
+
+    Same sampling as `engine.generate(context, ...)`: with the same seed the
+    tokens are the ones it returns after the context.
+    """
+    rng = np.random.default_rng(seed) if rng is None else rng
+    for tokens in engine.decode([context], max_new_tokens, rng, temperature, top_k):
+        yield int(tokens[0])
+
+
+def _held_back(text, stops):
+    ## length of the longest end of `text` that could still grow into a stop string
+    longest = 0
+    for stop in stops:
+        for k in range(min(len(stop) - 1, len(text)), longest, -1):
+            if text.endswith(stop[:k]):
+                longest = k
+                break
+    return longest
+
+
+class TextStream:
+    """Incremental decoding of one generated sequence, with stop strings.
+
+    `push(token)` decodes one token on its own, so the cost per token does
+    not grow with the text so far, and returns the text that is now safe
+    to hand out. Characters that could be the start of a stop string are
+    held back until a later token rules it out. Once a stop string (one
+    string or a list) appears, `stopped` is set and the text before it is
+    the last returned; the stop string itself never is. `flush()` returns
+    what is still held back when generation ends for another reason.
+    """
+
+    def __init__(self, tokenizer, stop=None):
+        self.tokenizer = tokenizer
+        stops = [stop] if isinstance(stop, str) else list(stop or ())
+        self.stops = [s for s in stops if s]
+        self.stopped = False
+        self._pending = ''
+
+    def push(self, token):
+        if self.stopped:
+            return ''
+        pending = self._pending + self.tokenizer.decode_token(token)
+        found = [i for i in (pending.find(s) for s in self.stops) if i >= 0]
+        if found:
+            self.stopped = True
+            self._pending = ''
+            return pending[:min(found)]
+        keep = _held_back(pending, self.stops)
+        self._pending = pending[len(pending) - keep:]
+        return pending[:len(pending) - keep]
+
+    def flush(self):
+        pending, self._pending = self._pending, ''
+        return '' if self.stopped else pending
+
+
+def stream_text(engine, tokenizer, prompt=None, max_new_tokens=500, seed=None, rng=None,
+                temperature=1.0, top_k=None, stop=None):
+    """Yield the generated text piece by piece, as each token is sampled.
+
+    `prompt` is a string (encoded with `tokenizer`); without one generation
+    starts from token 1, like the Stan programs. Generation ends after
+    `max_new_tokens` tokens or at the first `stop` string, which is not
+    yielded (see TextStream).
+
+        for piece in stream_text(engine, Tokenizer(checkpoint.vocabulary), "ROMEO:",
+                                 temperature=0.8, top_k=10, stop="\\n\\n"):
+            print(piece, end='', flush=True)
+    """
+    context = tokenizer.encode(prompt) if prompt else (1,)
+    text = TextStream(tokenizer, stop)
+    for token in stream_tokens(engine, context, max_new_tokens, seed, rng, temperature, top_k):
+        piece = text.push(token)
+        if piece:
+            yield piece
+        if text.stopped:
+            return
+    piece = text.flush()
+    if piece:
+        yield piece
+
+
+async def astream_text(engine, tokenizer, prompt=None, **kwargs):
+    """stream_text() as an async iterator.
+
+    Each decode step runs in a worker thread, so the event loop keeps
+    serving other tasks while a token is computed:
+
+        async for piece in astream_text(engine, tokenizer, "ROMEO:", stop="\\n\\n"):
+            await websocket.send(piece)
+    """
+    pieces = stream_text(engine, tokenizer, prompt, **kwargs)
+    done = object()
+    try:
+        while True:
+            piece = await asyncio.to_thread(next, pieces, done)
+            if piece is done:
+                return
+            yield piece
+    finally:
+        pieces.close()
@@ -0,0 +1,289 @@
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+from .data import BatchSampler, TINYSHAKESPEARE as TEXT
+from .stages import get_stage
+
+
+## the settings of every stage section in script-final.py, plus the optimizer's
+DEFAULTS = {'batch_size': 32, 'block_size': 8, 'n_embed': 32, 'n_head': 2, 'n_layer': 2, 'dropout': 0.2,
+            'learning_rate': 1e-3, 'max_iters': 1000, 'eval_interval': 100, 'eval_iters': 200, 'seed': 1337}
+TRAINING = ('learning_rate', 'max_iters', 'eval_interval', 'eval_iters', 'seed')
+
+RESULT_COLUMNS = ('run', 'stage', 'batch_size', 'block_size', 'n_embed', 'n_head', 'n_layer', 'dropout',
+                  'learning_rate', 'max_iters', 'train_loss', 'val_loss', 'tokens_per_second', 'seconds', 'error')
+
+
+def _config(stage, settings):
+    ## keep only what the stage reads, so stages without e.g. n_layer do not repeat runs
+    stage = get_stage(stage)
+    settings = dict(DEFAULTS, **settings)
+    config = {'stage': stage.name[:2]}
+    config.update({name: settings[name] for name in stage.hyperparameters if name != 'vocab_size'})
+    config.update({name: settings[name] for name in TRAINING})
+    return config
+
+
+def _unique_valid(configs):
+    seen, out = set(), []
+    for config in configs:
+        key = json.dumps(config, sort_keys=True)
+        if key in seen or config.get('n_embed', 0) % config.get('n_head', 1):
+            continue
+        seen.add(key)
+        out.append(config)
+    return out
+
+
+def grid(stages, **axes):
+    """Every combination of `stages` and the values of each axis, e.g. grid(['07', '12'], n_embed=[32, 64]).
+
+    Settings not given keep their DEFAULTS. Combinations a stage cannot tell
+    apart (an n_layer for a one-layer stage) are only run once; those with
+    n_embed not divisible by n_head are dropped.
+    """
+    names = list(axes)
+    return _unique_valid(_config(stage, dict(zip(names, values)))
+                         for stage in stages for values in itertools.product(*axes.values()))
+
+
+def random_configs(stages, n, seed=None, **axes):
+    """`n` random configurations: each axis is a list to choose from or a (low, high) range.
+
+    Integer ranges are drawn uniformly; float ranges log-uniformly when
+    both ends are positive (learning rates), uniformly otherwise.
+    """
+    rng = np.random.default_rng(seed)
+
+    def draw(values):
+        if isinstance(values, tuple):
+            low, high = values
+            if isinstance(low, int) and isinstance(high, int):
+                return int(rng.integers(low, high + 1))
+            if low > 0:
+                return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+            return float(rng.uniform(low, high))
+        return values[int(rng.integers(len(values)))]
+
+    return _unique_valid(_config(stages[int(rng.integers(len(stages)))],
+                                 {name: draw(values) for name, values in axes.items()})
+                         for _ in range(n))
+
+
+def run_config(config, directory, text_path=TEXT, model_lib=None, threads_per_step=None):
+    """Train one configuration with the in-process driver and AdamW; return its result row.
+
+    Writes config.json, metrics.jsonl (one record per step), the final
+    checkpoint and result.json to `directory`.
+    """
+    from .checkpoint import save_checkpoint
+    from .driver import StageDriver
+    from .metrics import MetricsLog
+    from .optim import AdamW
+    from .tokenizer import Tokenizer
+    from .train import train
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+    with open(text_path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    tokenizer = Tokenizer.from_text(text)
+    tokens = tokenizer.encode(text)
+    n = int(0.9 * len(tokens))
+    hyperparameters = dict(config, vocab_size=tokenizer.vocab_size)
+    batch_size, block_size, seed = config['batch_size'], config['block_size'], config['seed']
+    ## the train-split estimate has its own sampler, so evaluation leaves the training stream alone
+    get_batch = BatchSampler(tokens[:n], batch_size, block_size, seed=seed)
+    get_train_eval_batch = BatchSampler(tokens[:n], batch_size, block_size, seed=seed + 2)
+    get_val_batch = BatchSampler(tokens[n:], batch_size, block_size, seed=seed + 1)
+
+    driver = StageDriver(config['stage'], hyperparameters, model_lib=model_lib, seed=seed,
+                         threads_per_step=threads_per_step)
+    name = os.path.basename(os.path.normpath(directory))
+    start = time.perf_counter()
+    with MetricsLog(os.path.join(directory, 'metrics.jsonl'), config['stage'],
+                    tokens_per_step=batch_size * block_size, run=name) as metrics:
+        history = train(driver, AdamW(lr=config['learning_rate']), get_batch, config['max_iters'],
+                        get_val_batch=get_val_batch, get_train_eval_batch=get_train_eval_batch,
+                        eval_interval=config['eval_interval'],
+                        eval_iters=config['eval_iters'], on_eval=lambda step, losses, new_tokens: None,
+                        metrics=metrics)
+    seconds = time.perf_counter() - start
+    save_checkpoint(os.path.join(directory, 'checkpoint'), config['stage'], hyperparameters,
+                    driver.get_state(), tokenizer.chars, step=config['max_iters'])
+
+    _, losses = history[-1]
+    result = dict(config, run=name, stage=driver.stage.name, train_loss=losses['train'], val_loss=losses['val'],
+                  tokens_per_second=config['max_iters'] * batch_size * block_size / seconds,
+                  seconds=seconds, error=None)
+    with open(os.path.join(directory, 'result.json'), 'w') as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+def _pin(cores):
+    ## each pool process takes one set of cores for its lifetime
+    mine = cores.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, mine)
+
+
+def _run(config, directory, text_path, model_lib, threads_per_step):
+    try:
+        return run_config(config, directory, text_path, model_lib, threads_per_step)
+    except Exception:
+        error = traceback.format_exc()
+        with open(os.path.join(directory, 'error.txt'), 'w') as f:
+            f.write(error)
+        return dict(config, run=os.path.basename(directory), stage=get_stage(config['stage']).name,
+                    error=error.strip().splitlines()[-1])
+
+
+def _finished(directory, config):
+    ## a run of this exact configuration already completed there
+    try:
+        with open(os.path.join(directory, 'config.json')) as f:
+            same = json.load(f) == config
+        with open(os.path.join(directory, 'result.json')) as f:
+            return json.load(f) if same else None
+    except FileNotFoundError:
+        return None
+
+
+def run_sweep(configs, directory, text_path=TEXT, processes=None, cores_per_run=1, on_result=None):
+    """Train every configuration, several at once, and collect one results table.
+
+    Runs are scheduled over a pool of `processes` worker processes (default:
+    one per `cores_per_run` cores). Each worker is pinned to its own
+    `cores_per_run` cores (on Linux) and, with more than one, splits each
+    step's batch across them with `threads_per_step`. Every stage's model is
+    compiled once, through the ModelRegistry, before any run starts.
+
+    Run i writes to `directory/NNN-<stage>/`. Runs that already finished
+    with the same configuration are read back instead of run again, so an
+    interrupted sweep picks up where it stopped. The table is rewritten to
+    `directory/results.csv` as runs finish; `on_result(result)` is called for
+    each one. Returns the results sorted by validation loss (failed runs last).
+    """
+    from .registry import ModelRegistry
+
+    if hasattr(os, 'sched_getaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+    else:
+        available = list(range(os.cpu_count() or 1))
+    processes = processes or max(1, len(available) // cores_per_run)
+    threads_per_step = cores_per_run if cores_per_run > 1 else None
+    make_args = ['STAN_THREADS=true'] if threads_per_step else []
+
+    os.makedirs(directory, exist_ok=True)
+    runs = [(config, os.path.join(directory, f"{i:03d}-{config['stage']}")) for i, config in enumerate(configs)]
+    results, pending = [], []
+    for config, run_dir in runs:
+        result = _finished(run_dir, config)
+        if result is not None:
+            results.append(result)
+        else:
+            pending.append((config, run_dir))
+
+    stages = sorted({config['stage'] for config, _ in pending})
+    registry = ModelRegistry()
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as pool:
+        libraries = dict(zip(stages, pool.map(lambda stage: registry.library(stage, make_args=make_args), stages)))
+
+    context = multiprocessing.get_context('spawn')
+    cores = context.Queue()
+    for i in range(processes):
+        chosen = available[(i * cores_per_run) % len(available):][:cores_per_run] or available[:cores_per_run]
+        cores.put(set(chosen))
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                             initializer=_pin, initargs=(cores,)) as pool:
+        futures = [pool.submit(_run, config, run_dir, text_path, libraries[config['stage']], threads_per_step)
+                   for config, run_dir in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            write_results(os.path.join(directory, 'results.csv'), results)
+            if on_result is not None:
+                on_result(result)
+
+    results = _ranked(results)
+    write_results(os.path.join(directory, 'results.csv'), results)
+    return results
+
+
+def _ranked(results):
+    return sorted(results, key=lambda r: (r.get('error') is not None, r.get('val_loss') or float('inf')))
+
+
+def write_results(path, results):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, RESULT_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+
+def read_results(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def format_results(results):
+    columns = [c for c in RESULT_COLUMNS if c not in ('stage', 'error')]
+    lines = ["  ".join(f"{c:>13}" for c in columns)]
+    for result in _ranked(results):
+        cells = []
+        for c in columns:
+            value = result.get(c)
+            if value is None or value == '':
+                cells.append(f"{'-':>13}")
+            elif isinstance(value, float):
+                cells.append(f"{value:13.4g}")
+            else:
+                cells.append(f"{value!s:>13}")
+        line = "  ".join(cells)
+        if result.get('error'):
+            line += f"  FAILED: {result['error']}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train a grid (or random sample) of stage configurations in parallel.")
+    parser.add_argument('directory')
+    parser.add_argument('--stages', nargs='+', default=['12'])
+    for name in ('batch_size', 'block_size', 'n_embed', 'n_head', 'n_layer', 'max_iters'):
+        parser.add_argument('--' + name.replace('_', '-'), type=int, nargs='+', default=[DEFAULTS[name]])
+    for name in ('dropout', 'learning_rate'):
+        parser.add_argument('--' + name.replace('_', '-'), type=float, nargs='+', default=[DEFAULTS[name]])
+    parser.add_argument('--random', type=int, metavar='N',
+                        help="sample N configurations (two values of a float setting give a range) instead of the grid")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--text', default=TEXT)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--cores-per-run', type=int, default=1)
+    args = parser.parse_args()
+
+    axes = {name: getattr(args, name) for name in
+            ('batch_size', 'block_size', 'n_embed', 'n_head', 'n_layer', 'dropout', 'learning_rate', 'max_iters')}
+    if args.random:
+        axes.update({name: tuple(axes[name]) for name in ('dropout', 'learning_rate') if len(axes[name]) == 2})
+        configs = random_configs(args.stages, args.random, args.seed, **axes)
+    else:
+        configs = grid(args.stages, **axes)
+    print(f"{len(configs)} runs")
+    results = run_sweep(configs, args.directory, args.text, args.processes, args.cores_per_run,
+                        on_result=lambda r: print(f"{r['run']}: " + (f"FAILED {r['error']}" if r.get('error') else
+                                                                    f"val loss {r['val_loss']:.4f}, "
+                                                                    f"{r['tokens_per_second']:,.0f} tokens/s")))
+    print(format_results(results))
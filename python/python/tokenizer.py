@@ -0,0 +1,68 @@
+import numpy as np
+
+
+class Tokenizer:
+    """Character-level tokenizer with 1-indexed token ids.
+
+    Same vocabulary as encoder_decoder_1_indexed: the sorted characters of
+    the text, numbered from 1 (so existing Stan data stays valid). Encoding
+    goes through a 256-entry translation table with `bytes.translate`, so
+    the whole corpus becomes a `uint8` array in one call (one byte per
+    character instead of a Python int each). Decoding looks up whole arrays
+    at once.
+
+    Characters must be single bytes (latin-1), which covers tinyshakespeare.
+    """
+
+    def __init__(self, chars):
+        self.chars = ''.join(chars)
+        self.vocab_size = len(self.chars)
+        if self.vocab_size > 255:
+            raise ValueError(f"vocabulary of {self.vocab_size} characters does not fit in uint8 tokens")
+        codes = np.frombuffer(self._to_bytes(self.chars), dtype=np.uint8)
+
+        ## byte -> token id; 0 marks characters outside the vocabulary
+        encode_table = np.zeros(256, dtype=np.uint8)
+        encode_table[codes] = np.arange(1, self.vocab_size + 1)
+        self._encode_table = encode_table.tobytes()
+
+        ## token id -> byte; id 0 is unused
+        self._decode_table = np.zeros(self.vocab_size + 1, dtype=np.uint8)
+        self._decode_table[1:] = codes
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(sorted(set(text)))
+
+    @staticmethod
+    def _to_bytes(s):
+        try:
+            return s.encode('latin-1')
+        except UnicodeEncodeError as e:
+            raise ValueError(f"character {s[e.start]!r} is not a single byte") from e
+
+    def encode(self, s):
+        """String -> uint8 array of 1-indexed token ids."""
+        tokens = np.frombuffer(self._to_bytes(s).translate(self._encode_table), dtype=np.uint8)
+        if not tokens.all():
+            raise KeyError(s[int(np.argmin(tokens))])
+        return tokens
+
+    def decode(self, tokens):
+        """Token ids (any integer or float array-like, e.g. from stan_variable) -> string."""
+        ids = np.asarray(tokens).astype(np.intp)
+        if ids.size and (ids.min() < 1 or ids.max() > self.vocab_size):
+            raise KeyError(int(ids.min() if ids.min() < 1 else ids.max()))
+        return self._decode_table[ids].tobytes().decode('latin-1')
+
+    def decode_token(self, token):
+        """One token id -> its character, without building an array (for streaming)."""
+        token = int(token)
+        if not 1 <= token <= self.vocab_size:
+            raise KeyError(token)
+        return self.chars[token - 1]
+
+
+def encoder_decoder_1_indexed(text):
+    tokenizer = Tokenizer.from_text(text)
+    return tokenizer.encode, tokenizer.decode
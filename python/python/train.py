@@ -0,0 +1,158 @@
+from contextlib import nullcontext
+
+import numpy as np
+
+from .prefetch import Prefetcher
+
+
+## names of the estimated losses in a MetricsLog record, as in the stage programs
+_METRIC_KEYS = {'train': 'loss', 'val': 'loss_validation'}
+
+
+def _eval_overrides(driver):
+    ## evaluate without dropout, like model.eval() in reference/gpt-dev.py
+    return {'dropout': 0.0} if 'dropout' in driver.stage.hyperparameters else {}
+
+
+def estimate_loss(driver, get_batches, eval_iters=200):
+    """Average cross-entropy loss over `eval_iters` fresh batches per split.
+
+    `get_batches` maps a split name to a batch function, e.g.
+    {'train': ..., 'val': ...}. Only the transformed parameters are
+    evaluated; the generated quantities block never runs.
+    """
+    overrides = _eval_overrides(driver)
+    out = {}
+    for split, get_batch in get_batches.items():
+        losses = np.empty(eval_iters)
+        for k in range(eval_iters):
+            xb, yb = get_batch()
+            losses[k] = -driver.loss(driver.dump_data(xb, yb, **overrides))
+        out[split] = float(losses.mean())
+    return out
+
+
+def generate(driver, xb, yb, max_new_tokens=500, seed=None):
+    """Run the model's generated quantities block once and return `new_tokens`."""
+    data = driver.dump_data(xb, yb, max_new_tokens=max_new_tokens, **_eval_overrides(driver))
+    return driver.generated_quantities(data, seed=seed)['new_tokens']
+
+
+def train(driver, optimizer, get_batch, max_iters, get_val_batch=None,
+          eval_interval=100, eval_iters=200, max_new_tokens=0, on_eval=None, prefetch=2,
+          workers=None, accumulation_steps=1, metrics=None, get_train_eval_batch=None):
+    """Minibatch training of a stage model with a persistent optimizer.
+
+    Training steps only evaluate the log density and its gradient: each
+    step draws `xb, yb = get_batch()` and lets `optimizer` take one step on
+    `driver.theta`. The optimizer minimizes, so it is handed the gradient of
+    the negative log density (the cross-entropy loss plus the priors).
+
+    Every `eval_interval` steps, and at the last step, the train and
+    validation losses are estimated over `eval_iters` batches before that
+    step's update, as in reference/gpt-dev.py. If
+    `max_new_tokens` is positive, tokens are also generated then.
+    `on_eval(step, losses, new_tokens)` is called with the results;
+    without it the losses are printed.
+
+    Training batches are drawn and serialized by a background thread,
+    `prefetch` steps ahead, so the next step's data is ready as soon as the
+    gradient is; `prefetch=0` prepares each batch in the loop instead.
+    Only that stream calls `get_batch`: the train-split estimate, and the
+    batch generation starts from, take the next batches of the stream
+    rather than drawing on their own, so a seeded run gives the same result
+    with or without prefetching. With `get_train_eval_batch` the train
+    split is estimated on that sampler instead and evaluation leaves the
+    training stream alone.
+
+    With `accumulation_steps` K > 1, each optimizer step draws K batches
+    and averages their gradients: an effective batch K times the model's
+    `batch_size`, with only one batch's autodiff tape in memory at a time.
+
+    With `workers` (a `python.parallel.DataParallel` around `driver`) each
+    step's batch is split across worker processes and their gradients are
+    averaged; evaluation and generation still run on `driver`.
+
+    With `metrics` (a `python.metrics.MetricsLog`) every step is logged with
+    the time spent in each phase (sample, serialize, wait_for_batch,
+    gradient, optimizer, evaluate), the batch's log density `lp` (the
+    log likelihood plus the priors, so not the loss) and, on evaluation
+    steps, the estimated losses as `loss` and `loss_validation`, the keys
+    the CmdStan loops use and the summary reads.
+
+    Returns the list of (step, losses) evaluations.
+    """
+    if accumulation_steps < 1:
+        raise ValueError(f"accumulation_steps must be at least 1, got {accumulation_steps}")
+    phase = metrics.phase if metrics is not None else (lambda name: nullcontext())
+
+    def next_data():
+        ## (batch, what the gradient reads): the raw batch is kept for evaluation
+        with phase('sample'):
+            batch = get_batch()
+        if workers is not None:
+            ## the workers read the raw token arrays out of shared memory
+            return batch, batch
+        with phase('serialize'):
+            return batch, driver.dump_data(*batch)
+
+    def draw():
+        return batches.get() if batches is not None else next_data()
+
+    if get_train_eval_batch is None:
+        def get_train_eval_batch():
+            return draw()[0]
+    get_batches = {'train': get_train_eval_batch}
+    if get_val_batch is not None:
+        get_batches['val'] = get_val_batch
+
+    def gradient(out):
+        with phase('wait_for_batch'):
+            _, data = draw()
+        with phase('gradient'):
+            if workers is not None:
+                return workers.log_density_gradient(*data, out=out)
+            return driver.log_density_gradient(data, out=out)
+
+    batches = Prefetcher(next_data, prefetch) if prefetch else None
+    history = []
+    grad = None
+    total = None
+    try:
+        for step in range(max_iters):
+            losses = None
+            if eval_interval and (step % eval_interval == 0 or step == max_iters - 1):
+                with phase('evaluate'):
+                    losses = estimate_loss(driver, get_batches, eval_iters)
+                    new_tokens = None
+                    if max_new_tokens > 0:
+                        new_tokens = generate(driver, *get_train_eval_batch(), max_new_tokens)
+                history.append((step, losses))
+                if on_eval is not None:
+                    on_eval(step, losses, new_tokens)
+                else:
+                    print(f"step {step}: " + ", ".join(f"{split} loss {loss:.4f}" for split, loss in losses.items()))
+
+            lp, grad = gradient(grad)
+            step_grad = grad
+            if accumulation_steps > 1:
+                if total is None:
+                    total = np.empty_like(grad)
+                np.copyto(total, grad)
+                for _ in range(accumulation_steps - 1):
+                    micro_lp, grad = gradient(grad)
+                    lp += micro_lp
+                    total += grad
+                lp /= accumulation_steps
+                total /= accumulation_steps
+                step_grad = total
+            with phase('optimizer'):
+                np.negative(step_grad, out=step_grad)
+                optimizer.step(driver.theta, step_grad)
+            if metrics is not None:
+                metrics.step(step, lp=lp, **({_METRIC_KEYS.get(split, f'loss_{split}'): loss
+                                              for split, loss in losses.items()} if losses is not None else {}))
+    finally:
+        if batches is not None:
+            batches.close()
+    return history
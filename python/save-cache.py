@@ -1,23 +1,8 @@
-import random
-import os
-from cmdstanpy import CmdStanModel
-import cmdstanpy
-
-def encoder_decoder_1_indexed(text):
-    chars = sorted(list(set(text)))
-    vocab_size = len(chars)
-    stoi = { ch:(i + 1) for i,ch in enumerate(chars) }
-    encode = lambda s: [stoi[c]  for c in s]  # encoder: take a string, output list of ints
-    itos = { (i + 1):ch for i,ch in enumerate(chars) }
-    decode = lambda l: ''.join([itos[i] for i in l]) # decoder; take a list of ints, output string
-    return encode, decode
-
-
-def get_data_batch(data, batch_size, block_size):
-    idx = random.sample(range(0, len(data) - block_size), batch_size)
-    x = [data[i:i+block_size] for i in idx]
-    y = [data[i+1:i+block_size+1] for i in idx]
-    return x, y
+from python.registry import ModelRegistry
+from python.tokenizer import encoder_decoder_1_indexed
+from python.data import get_data_batch
+from python.prefetch import StanDataFiles
+from python.checkpoint import save_checkpoint
 
 
 ## Read Shakespeare data
@@ -36,7 +21,7 @@ data_val = data_full[n:]
 
 
 
-model_07 = CmdStanModel(stan_file=os.path.join('..', 'stan', '07-skip-connections.stan'))
+model_07 = ModelRegistry().model('07')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -60,23 +45,24 @@ data = {
 }
 
 optimum_07 = model_07.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+## the steps only need the losses: no tokens are generated until after the loop
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size))
 for step in range(10000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_07 = model_07.optimize(data = data, show_console=(step % 100 == 0),
+    if step % 100 == 0:
+        print("step = ", step)
+    optimum_07 = model_07.optimize(data = batches.get(), show_console=(step % 100 == 0),
                                    iter=1, init_alpha=0.0001, algorithm="LBFGS",
                                    inits=optimum_07.stan_variables())
+batches.close()
 
 print(optimum_07.stan_variable('loss'))
 print(optimum_07.stan_variable('loss_validation'))
 
-print(decode(optimum_07.stan_variable('new_tokens')))
-    
+gq_07 = model_07.generate_quantities(data=data, previous_fit=optimum_07)
+print(decode(gq_07.stan_variable('new_tokens')[0]))
+
 
-cmdstanpy.write_stan_json('../cache/model_07_data.json', data)
-optimum_07.save_csvfiles('../cache/')
+## Only the parameters are kept: one .npy file each, plus metadata.json
+save_checkpoint('../cache/07-skip-connections', '07', data, optimum_07.stan_variables(),
+                sorted(set(text)), step=10000)
@@ -1,25 +1,12 @@
-import random
-import os
-from cmdstanpy import CmdStanModel
+from python.registry import ModelRegistry
+from python.tokenizer import encoder_decoder_1_indexed
+from python.data import get_data_batch
+from python.prefetch import StanDataFiles
+from python.metrics import MetricsLog, timed_optimize, read_metrics, summarize, format_summary
+from python.profiling import ProfileCollector
 
 verbose = True
 
-def encoder_decoder_1_indexed(text):
-    chars = sorted(list(set(text)))
-    vocab_size = len(chars)
-    stoi = { ch:(i + 1) for i,ch in enumerate(chars) }
-    encode = lambda s: [stoi[c]  for c in s]  # encoder: take a string, output list of ints
-    itos = { (i + 1):ch for i,ch in enumerate(chars) }
-    decode = lambda l: ''.join([itos[i] for i in l]) # decoder; take a list of ints, output string
-    return encode, decode
-
-
-def get_data_batch(data, batch_size, block_size):
-    idx = random.sample(range(0, len(data) - block_size), batch_size)
-    x = [data[i:i+block_size] for i in idx]
-    y = [data[i+1:i+block_size+1] for i in idx]
-    return x, y
-
 
 def print_shakespeare_data_info(text):
     print("************************************************************")
@@ -98,13 +85,19 @@ if (verbose):
 
 ## Start of Language models
 
+## Compiled models are kept in ../build/models, keyed by the hash of each Stan file:
+## a cold start compiles all twelve, four at a time (each compile needs 1-2 GB; raise
+## it with models.compile(jobs=...) on a machine with more memory), a warm start compiles nothing.
+models = ModelRegistry()
+models.compile()
+
 
 ############################################################
 ## 01: bigram model
 ##     Only look at the last character to predict the next character.
 ##     Look at how to compute loss
 ##     Look at optimization
-model_01 = CmdStanModel(stan_file=os.path.join('..', 'stan', '01-bigram.stan'))
+model_01 = models.model('01')
 
 
 vocab_size = len(set(text))   # total number of characters in the text
@@ -141,23 +134,25 @@ print(decode(gq_01.stan_variable('new_tokens')[0]))
 ## Stochastic LBFGS
 optimum_01 = model_01.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS")
 
+## the steps only need the losses: no tokens are generated until after the loop
+metrics = MetricsLog('metrics.jsonl', '01', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_01 = model_01.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_01.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_01 = timed_optimize(metrics, model_01, batch, optimum_01,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS")
+    metrics.step(step, loss=-float(optimum_01.stan_variable('loss')),
+                 loss_validation=-float(optimum_01.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_01.stan_variable('loss'))
 print(optimum_01.stan_variable('loss_validation'))
 
-print(decode(optimum_01.stan_variable('new_tokens')))
-
 gq_01 = model_01.generate_quantities(data=data, previous_fit=optimum_01)
 print(decode(gq_01.stan_variable('new_tokens')[0]))
 
@@ -167,7 +162,7 @@ print(decode(gq_01.stan_variable('new_tokens')[0]))
 ## 02: embedding
 ##     Instead of directly using logits of vocab_size, estimate a vector of size n_embed (> vocab_size)
 ##     To get it back to vocab_size, matrix multiply
-model_02 = CmdStanModel(stan_file=os.path.join('..', 'stan', '02-different-embedding-size.stan'))
+model_02 = models.model('02')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -190,23 +185,24 @@ data = {
 
 optimum_02 = model_02.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS")
 
+metrics = MetricsLog('metrics.jsonl', '02', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_02 = model_02.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_02.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_02 = timed_optimize(metrics, model_02, batch, optimum_02,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS")
+    metrics.step(step, loss=-float(optimum_02.stan_variable('loss')),
+                 loss_validation=-float(optimum_02.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_02.stan_variable('loss'))
 print(optimum_02.stan_variable('loss_validation'))
 
-print(decode(optimum_02.stan_variable('new_tokens')))
-
 gq_02 = model_02.generate_quantities(data=data, previous_fit=optimum_02)
 print(decode(gq_02.stan_variable('new_tokens')[0]))
 
@@ -215,7 +211,7 @@ print(decode(gq_02.stan_variable('new_tokens')[0]))
 ## 03: position encoding
 ##     Use positional encoding. Acts as an "intercept" on the logit scale for each position in block_size.
 ##     Only uses the last character; take a look at the generation code
-model_03 = CmdStanModel(stan_file=os.path.join('..', 'stan', '03-positional-encoding.stan'))
+model_03 = models.model('03')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -238,23 +234,24 @@ data = {
 
 optimum_03 = model_03.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
 
+metrics = MetricsLog('metrics.jsonl', '03', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_03 = model_03.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_03.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_03 = timed_optimize(metrics, model_03, batch, optimum_03,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS")
+    metrics.step(step, loss=-float(optimum_03.stan_variable('loss')),
+                 loss_validation=-float(optimum_03.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_03.stan_variable('loss'))
 print(optimum_03.stan_variable('loss_validation'))
 
-print(decode(optimum_03.stan_variable('new_tokens')))
-
 gq_03 = model_03.generate_quantities(data=data, previous_fit=optimum_03)
 print(decode(gq_03.stan_variable('new_tokens')[0]))
 
@@ -262,7 +259,7 @@ print(decode(gq_03.stan_variable('new_tokens')[0]))
 ############################################################
 ## 04: self-attention
 
-model_04 = CmdStanModel(stan_file=os.path.join('..', 'stan', '04-self-attention.stan'))
+model_04 = models.model('04')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -285,23 +282,28 @@ data = {
 }
 
 optimum_04 = model_04.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+## time per sublayer, from the profile blocks of stages 04 to 12
+profiles = ProfileCollector()
+metrics = MetricsLog('metrics.jsonl', '04', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_04 = model_04.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_04.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_04 = timed_optimize(metrics, model_04, batch, optimum_04,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('04', optimum_04)
+    metrics.step(step, loss=-float(optimum_04.stan_variable('loss')),
+                 loss_validation=-float(optimum_04.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_04.stan_variable('loss'))
 print(optimum_04.stan_variable('loss_validation'))
 
-print(decode(optimum_04.stan_variable('new_tokens')))
-
 gq_04 = model_04.generate_quantities(data=data, previous_fit=optimum_04)
 print(decode(gq_04.stan_variable('new_tokens')[0]))
 
@@ -309,7 +311,7 @@ print(decode(gq_04.stan_variable('new_tokens')[0]))
 
 ############################################################
 ## 05: multi-head self-attention
-model_05 = CmdStanModel(stan_file=os.path.join('..', 'stan', '05-multi-headed-self-attention.stan'))
+model_05 = models.model('05')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -333,23 +335,26 @@ data = {
 }
 
 optimum_05 = model_05.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+metrics = MetricsLog('metrics.jsonl', '05', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_05 = model_05.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_05.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_05 = timed_optimize(metrics, model_05, batch, optimum_05,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('05', optimum_05)
+    metrics.step(step, loss=-float(optimum_05.stan_variable('loss')),
+                 loss_validation=-float(optimum_05.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_05.stan_variable('loss'))
 print(optimum_05.stan_variable('loss_validation'))
 
-print(decode(optimum_05.stan_variable('new_tokens')))
-
 gq_05 = model_05.generate_quantities(data=data, previous_fit=optimum_05)
 print(decode(gq_05.stan_variable('new_tokens')[0]))
 
@@ -357,7 +362,7 @@ print(decode(gq_05.stan_variable('new_tokens')[0]))
 
 ############################################################
 ## 06: feed forward
-model_06 = CmdStanModel(stan_file=os.path.join('..', 'stan', '06-feed-forward.stan'))
+model_06 = models.model('06')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -381,23 +386,26 @@ data = {
 }
 
 optimum_06 = model_06.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+metrics = MetricsLog('metrics.jsonl', '06', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_06 = model_06.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_06.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_06 = timed_optimize(metrics, model_06, batch, optimum_06,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('06', optimum_06)
+    metrics.step(step, loss=-float(optimum_06.stan_variable('loss')),
+                 loss_validation=-float(optimum_06.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_06.stan_variable('loss'))
 print(optimum_06.stan_variable('loss_validation'))
 
-print(decode(optimum_06.stan_variable('new_tokens')))
-
 gq_06 = model_06.generate_quantities(data=data, previous_fit=optimum_06)
 print(decode(gq_06.stan_variable('new_tokens')[0]))
 
@@ -407,7 +415,7 @@ print(decode(gq_06.stan_variable('new_tokens')[0]))
 ## 07: skip connections
 ##     Math trick to have gradients work through
 ## PROMISING AS A MID POINT
-model_07 = CmdStanModel(stan_file=os.path.join('..', 'stan', '07-skip-connections.stan'))
+model_07 = models.model('07')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -431,30 +439,33 @@ data = {
 }
 
 optimum_07 = model_07.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+metrics = MetricsLog('metrics.jsonl', '07', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_07 = model_07.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_07.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_07 = timed_optimize(metrics, model_07, batch, optimum_07,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('07', optimum_07)
+    metrics.step(step, loss=-float(optimum_07.stan_variable('loss')),
+                 loss_validation=-float(optimum_07.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_07.stan_variable('loss'))
 print(optimum_07.stan_variable('loss_validation'))
 
-print(decode(optimum_07.stan_variable('new_tokens')))
-
 gq_07 = model_07.generate_quantities(data=data, previous_fit=optimum_07)
 print(decode(gq_07.stan_variable('new_tokens')[0]))
 
 
 ############################################################
 ## 08: larger feed forward layer
-model_08 = CmdStanModel(stan_file=os.path.join('..', 'stan', '08-larger-feed-forward-layer.stan'))
+model_08 = models.model('08')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -478,23 +489,26 @@ data = {
 }
 
 optimum_08 = model_08.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+metrics = MetricsLog('metrics.jsonl', '08', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_08 = model_08.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_08.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_08 = timed_optimize(metrics, model_08, batch, optimum_08,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('08', optimum_08)
+    metrics.step(step, loss=-float(optimum_08.stan_variable('loss')),
+                 loss_validation=-float(optimum_08.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_08.stan_variable('loss'))
 print(optimum_08.stan_variable('loss_validation'))
 
-print(decode(optimum_08.stan_variable('new_tokens')))
-
 gq_08 = model_08.generate_quantities(data=data, previous_fit=optimum_08)
 print(decode(gq_08.stan_variable('new_tokens')[0]))
 
@@ -502,7 +516,7 @@ print(decode(gq_08.stan_variable('new_tokens')[0]))
 
 ############################################################
 ## 09: layer norm
-model_09 = CmdStanModel(stan_file=os.path.join('..', 'stan', '09-layer-norm.stan'))
+model_09 = models.model('09')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -526,30 +540,33 @@ data = {
 }
 
 optimum_09 = model_09.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+metrics = MetricsLog('metrics.jsonl', '09', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_09 = model_09.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_09.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_09 = timed_optimize(metrics, model_09, batch, optimum_09,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('09', optimum_09)
+    metrics.step(step, loss=-float(optimum_09.stan_variable('loss')),
+                 loss_validation=-float(optimum_09.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_09.stan_variable('loss'))
 print(optimum_09.stan_variable('loss_validation'))
 
-print(decode(optimum_09.stan_variable('new_tokens')))
-
 gq_09 = model_09.generate_quantities(data=data, previous_fit=optimum_09)
 print(decode(gq_09.stan_variable('new_tokens')[0]))
 
 
 ############################################################
 ## 10: blocks
-model_10 = CmdStanModel(stan_file=os.path.join('..', 'stan', '10-blocks.stan'))
+model_10 = models.model('10')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -576,30 +593,33 @@ data = {
 }
 
 optimum_10 = model_10.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+metrics = MetricsLog('metrics.jsonl', '10', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_10 = model_10.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_10.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_10 = timed_optimize(metrics, model_10, batch, optimum_10,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('10', optimum_10)
+    metrics.step(step, loss=-float(optimum_10.stan_variable('loss')),
+                 loss_validation=-float(optimum_10.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_10.stan_variable('loss'))
 print(optimum_10.stan_variable('loss_validation'))
 
-print(decode(optimum_10.stan_variable('new_tokens')))
-
 gq_10 = model_10.generate_quantities(data=data, previous_fit=optimum_10)
 print(decode(gq_10.stan_variable('new_tokens')[0]))
 
 
 ############################################################
 ## 11: dropout
-model_11 = CmdStanModel(stan_file=os.path.join('..', 'stan', '11-dropout.stan'))
+model_11 = models.model('11')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -628,30 +648,33 @@ data = {
 }
 
 optimum_11 = model_11.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+metrics = MetricsLog('metrics.jsonl', '11', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_11 = model_11.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_11.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_11 = timed_optimize(metrics, model_11, batch, optimum_11,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('11', optimum_11)
+    metrics.step(step, loss=-float(optimum_11.stan_variable('loss')),
+                 loss_validation=-float(optimum_11.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_11.stan_variable('loss'))
 print(optimum_11.stan_variable('loss_validation'))
 
-print(decode(optimum_11.stan_variable('new_tokens')))
-
 gq_11 = model_11.generate_quantities(data=data, previous_fit=optimum_11)
 print(decode(gq_11.stan_variable('new_tokens')[0]))
 
 
 ############################################################
 ## 12: final - projection
-model_12 = CmdStanModel(stan_file=os.path.join('..', 'stan', '12-final.stan'))
+model_12 = models.model('12')
 
 vocab_size = len(set(text))   # total number of characters in the text
 batch_size = 32  # how many independent sequences will we process in parallel;  B
@@ -680,23 +703,26 @@ data = {
 }
 
 optimum_12 = model_12.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+metrics = MetricsLog('metrics.jsonl', '12', tokens_per_step=batch_size * block_size)
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_12 = model_12.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_12.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_12 = timed_optimize(metrics, model_12, batch, optimum_12,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('12', optimum_12)
+    metrics.step(step, loss=-float(optimum_12.stan_variable('loss')),
+                 loss_validation=-float(optimum_12.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_12.stan_variable('loss'))
 print(optimum_12.stan_variable('loss_validation'))
 
-print(decode(optimum_12.stan_variable('new_tokens')))
-
 gq_12 = model_12.generate_quantities(data=data, previous_fit=optimum_12)
 print(decode(gq_12.stan_variable('new_tokens')[0]))
 
@@ -704,6 +730,8 @@ print(decode(gq_12.stan_variable('new_tokens')[0]))
 
 
 ## Try something bigger, staying under 16 GB ram on my laptop
+## (python -m python.planner 12 --batch-size 16 --block-size 64 --n-embed 128 --n-head 4 --n-layer 4 --memory 16GB
+##  estimates the memory and cost of a step and the largest batch that fits)
 vocab_size = len(set(text))
 batch_size = 16 # how many independent sequences will we process in parallel?
 block_size = 64 # what is the maximum context length for predictions?
@@ -728,19 +756,32 @@ data = {
 }
 
 optimum_12 = model_12.optimize(data=data, show_console=True, iter=1, init_alpha=0.0001, algorithm="LBFGS", inits=0.1)
+metrics = MetricsLog('metrics.jsonl', '12', tokens_per_step=batch_size * block_size, run='12-final-large')
+batches = StanDataFiles(dict(data, max_new_tokens=0), lambda: get_data_batch(data_train, batch_size, block_size),
+                        lambda: get_data_batch(data_val, batch_size, block_size),
+                        metrics=metrics)
 for step in range(1000):
-    print("step = ", step)
-    xb, yb = get_data_batch(data_train, batch_size, block_size)
-    xb_val, yb_val = get_data_batch(data_val, batch_size, block_size)
-    data['xb'] = xb
-    data['yb'] = yb
-    data['xb_val'] = xb_val
-    data['yb_val'] = yb_val
-    optimum_12 = model_12.optimize(data = data, show_console=(step % 100 == 0),
-                                   iter=1, init_alpha=0.0001, algorithm="LBFGS",
-                                   inits=optimum_12.stan_variables())
+    with metrics.phase('wait_for_batch'):
+        batch = batches.get()
+    optimum_12 = timed_optimize(metrics, model_12, batch, optimum_12,
+                                show_console=(step % 100 == 0),
+                                iter=1, init_alpha=0.0001, algorithm="LBFGS",
+                                save_profile=True)
+    profiles.add('12', optimum_12, run='12-final-large')
+    metrics.step(step, loss=-float(optimum_12.stan_variable('loss')),
+                 loss_validation=-float(optimum_12.stan_variable('loss_validation')))
+batches.close()
+metrics.close()
 
 print(optimum_12.stan_variable('loss'))
 print(optimum_12.stan_variable('loss_validation'))
 
-print(decode(optimum_12.stan_variable('new_tokens')))
+gq_12 = model_12.generate_quantities(data=data, previous_fit=optimum_12)
+print(decode(gq_12.stan_variable('new_tokens')[0]))
+
+
+## where the time went, per stage
+print(format_summary(summarize(read_metrics('metrics.jsonl'))))
+
+## and, from stage 04 on, which sublayers of the model it went to
+print(profiles.format_report())
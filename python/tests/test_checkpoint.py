@@ -0,0 +1,60 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from python.checkpoint import METADATA_FILE, load_checkpoint, save_checkpoint
+from python.params import ParameterManifest, ParameterState
+
+
+HYPERPARAMETERS = {'vocab_size': 65, 'batch_size': 4, 'block_size': 8, 'n_embed': 16, 'n_head': 2,
+                   'xb': [[1]], 'max_new_tokens': 500}
+VOCABULARY = ''.join(chr(c) for c in range(32, 97))
+
+
+def random_state(stage='07'):
+    manifest = ParameterManifest.for_stage(stage, HYPERPARAMETERS)
+    return ParameterState(manifest, np.random.default_rng(0).normal(size=manifest.size))
+
+
+def test_round_trip(tmp_path):
+    state = random_state()
+    save_checkpoint(tmp_path, '07', HYPERPARAMETERS, state, VOCABULARY, step=10000)
+    checkpoint = load_checkpoint(tmp_path)
+    assert checkpoint.stage.name == '07-skip-connections'
+    ## only the stage's hyperparameters are kept, not the rest of the data
+    assert checkpoint.hyperparameters == {'vocab_size': 65, 'batch_size': 4, 'block_size': 8,
+                                          'n_embed': 16, 'n_head': 2}
+    assert checkpoint.vocabulary == VOCABULARY
+    assert checkpoint.step == 10000
+    assert list(checkpoint.parameters) == state.manifest.names
+    for name, value in state.stan_variables().items():
+        np.testing.assert_array_equal(checkpoint.parameters[name], value)
+        assert not checkpoint.parameters[name].flags.writeable
+
+
+def test_stan_variables_are_accepted(tmp_path):
+    state = random_state()
+    save_checkpoint(tmp_path, '07', HYPERPARAMETERS, dict(state.stan_variables(), loss=-4.2), VOCABULARY)
+    checkpoint = load_checkpoint(tmp_path, mmap=False)
+    assert 'loss' not in checkpoint.parameters
+    np.testing.assert_array_equal(ParameterState.from_stan_variables(state.manifest, checkpoint.parameters).values,
+                                  state.values)
+
+
+def test_mismatched_state(tmp_path):
+    with pytest.raises(ValueError):
+        save_checkpoint(tmp_path, '07', HYPERPARAMETERS, random_state('05'), VOCABULARY)
+
+
+def test_unknown_format_version(tmp_path):
+    save_checkpoint(tmp_path, '07', HYPERPARAMETERS, random_state(), VOCABULARY)
+    path = os.path.join(tmp_path, METADATA_FILE)
+    with open(path) as f:
+        metadata = json.load(f)
+    metadata['format_version'] = 2
+    with open(path, 'w') as f:
+        json.dump(metadata, f)
+    with pytest.raises(ValueError):
+        load_checkpoint(tmp_path)
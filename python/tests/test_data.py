@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from python.data import BatchSampler, get_data_batch
+
+
+## token i of the corpus is i, so each row starts with its offset
+DATA = np.arange(1000, dtype=np.uint16)
+
+
+def test_shapes_and_targets():
+    xb, yb = BatchSampler(DATA, batch_size=32, block_size=8, seed=0).sample()
+    assert xb.shape == yb.shape == (32, 8)
+    assert xb.dtype == yb.dtype == np.int32
+    assert xb.flags.c_contiguous and yb.flags.c_contiguous
+    ## every row is a window of the corpus and its targets are the next tokens
+    np.testing.assert_array_equal(xb, xb[:, :1] + np.arange(8))
+    np.testing.assert_array_equal(yb, xb + 1)
+
+
+def test_offsets_without_replacement_and_in_range():
+    xb, yb = BatchSampler(DATA, batch_size=500, block_size=8, seed=0).sample()
+    assert len(set(xb[:, 0])) == 500
+    assert yb.max() <= DATA[-1]
+
+
+def test_seeding():
+    first = BatchSampler(DATA, 16, 8, seed=1337)
+    second = BatchSampler(DATA, 16, 8, seed=1337)
+    for _ in range(3):
+        for a, b in zip(first(), second()):
+            np.testing.assert_array_equal(a, b)
+    other = BatchSampler(DATA, 16, 8, seed=1338)
+    assert not np.array_equal(first()[0], other()[0])
+
+
+def test_corpus_too_short():
+    with pytest.raises(ValueError):
+        BatchSampler(DATA[:8], 1, 8)
+
+
+def test_get_data_batch():
+    xb, yb = get_data_batch(DATA, 4, 8, np.random.default_rng(0))
+    assert xb.shape == yb.shape == (4, 8)
+    np.testing.assert_array_equal(yb, xb + 1)
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+
+from python.inference import InferenceEngine
+from python.params import ParameterManifest, ParameterState
+from python.stages import STAGES
+
+
+HYPERPARAMETERS = {'vocab_size': 65, 'batch_size': 2, 'block_size': 4, 'n_embed': 8, 'n_head': 2,
+                   'n_layer': 2, 'dropout': 0.0}
+
+## `loss` of each stage program (the mean log likelihood of the batch below) at the
+## parameters below, computed by Stan
+STAN_LOSS = {
+    '01-bigram': -4.147481990295761,
+    '02-different-embedding-size': -4.395722560644596,
+    '03-positional-encoding': -4.440910913078519,
+    '04-self-attention': -4.465542302523437,
+    '05-multi-headed-self-attention': -4.485235636420757,
+    '06-feed-forward': -4.5060088657778365,
+    '07-skip-connections': -4.56413140394015,
+    '08-larger-feed-forward-layer': -4.4534873532971435,
+    '09-layer-norm': -4.89839268674239,
+    '10-blocks': -4.46653518496303,
+    '11-dropout': -4.46653518496303,
+    '12-final': -4.447257779791311,
+}
+
+
+def parameters(stage, scale=0.3):
+    manifest = ParameterManifest.for_stage(stage, HYPERPARAMETERS)
+    return ParameterState(manifest, np.random.default_rng(0).normal(0, scale, manifest.size)).stan_variables()
+
+
+def batch():
+    rng = np.random.default_rng(1)
+    return rng.integers(1, 66, size=(2, 4)), rng.integers(1, 66, size=(2, 4))
+
+
+def mean_log_likelihood(logits, yb):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    logits -= np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+    return np.take_along_axis(logits, np.asarray(yb)[..., None] - 1, axis=-1).mean()
+
+
+@pytest.mark.parametrize('stage', list(STAGES))
+def test_loss_matches_stan(stage):
+    xb, yb = batch()
+    engine = InferenceEngine(parameters(stage), stage)
+    logits = engine.forward(xb)
+    assert logits.shape == (2, 4, 65)
+    assert mean_log_likelihood(logits, yb) == pytest.approx(STAN_LOSS[STAGES[stage].name], rel=1e-12)
+
+
+@pytest.mark.parametrize('stage', ['03', '05', '12'])
+def test_cache_matches_full_forward_pass(stage):
+    xb, _ = batch()
+    engine = InferenceEngine(parameters(stage), stage)
+    cache = engine.new_cache(2)
+    one_at_a_time = np.concatenate([engine.forward(xb[:, t:t + 1], t, cache) for t in range(4)], axis=1)
+    np.testing.assert_allclose(one_at_a_time, engine.forward(xb), rtol=1e-12, atol=1e-12)
+
+
+def test_sample():
+    engine = InferenceEngine(parameters('12'), '12')
+    logits = np.random.default_rng(0).normal(size=(3, 65))
+    draw = lambda seed, **kwargs: engine.sample(logits, np.random.default_rng(seed), **kwargs)
+    np.testing.assert_array_equal(draw(5), draw(5))
+    assert ((draw(5) >= 1) & (draw(5) <= 65)).all()
+    np.testing.assert_array_equal(draw(0, temperature=0), logits.argmax(axis=-1) + 1)
+    np.testing.assert_array_equal(draw(1, top_k=1), logits.argmax(axis=-1) + 1)
+    top_3 = np.argsort(logits, axis=-1)[:, -3:] + 1
+    for seed in range(20):
+        assert all(token in row for token, row in zip(draw(seed, top_k=3), top_3))
+
+
+def test_generate_shapes_and_seeding():
+    engine = InferenceEngine(parameters('12'), '12')
+    tokens = engine.generate(max_new_tokens=20, seed=1)
+    assert tokens.shape == (21,) and tokens[0] == 1
+    assert ((tokens >= 1) & (tokens <= 65)).all()
+    np.testing.assert_array_equal(tokens, engine.generate(max_new_tokens=20, seed=1))
+    assert engine.generate(np.ones((3, 2), dtype=int), max_new_tokens=5, seed=1).shape == (3, 7)
+
+
+@pytest.mark.parametrize('stage', ['01', '04', '12'])
+def test_batched_greedy_decoding_matches_one_prompt_at_a_time(stage):
+    ## ragged prompts, two of them longer than block_size, so some windows grow and others slide
+    engine = InferenceEngine(parameters(stage), stage)
+    rng = np.random.default_rng(2)
+    prompts = [rng.integers(1, 66, size=n) for n in (1, 3, 4, 6, 9)]
+    batched = engine.generate_batch(prompts, max_new_tokens=12, temperature=0)
+    for prompt, new_tokens in zip(prompts, batched):
+        alone = engine.generate(prompt, max_new_tokens=12, temperature=0)
+        np.testing.assert_array_equal(new_tokens, alone[len(prompt):])
+        ## and without the KV cache: the full forward pass over the last block_size tokens
+        tokens = list(prompt)
+        for _ in range(12):
+            tokens.append(engine.forward(np.array([tokens[-(engine.block_size or 1):]]))[0, -1].argmax() + 1)
+        np.testing.assert_array_equal(new_tokens, tokens[len(prompt):])
@@ -0,0 +1,88 @@
+import math
+
+import numpy as np
+import pytest
+
+from python.optim import SGD, Adam, AdamW, cosine_schedule, step_schedule
+
+
+GRADIENTS = np.random.default_rng(0).normal(size=(5, 10))
+START = np.random.default_rng(1).normal(size=10)
+
+
+def run(optimizer, gradients=GRADIENTS):
+    params = START.copy()
+    for grad in gradients:
+        optimizer.step(params, grad)
+    return params
+
+
+def adam_reference(gradients, lr, beta1=0.9, beta2=0.999, eps=1e-8, weight_decay=0.0, decoupled=False):
+    ## Algorithm 1 of Kingma & Ba, with L2 or decoupled (AdamW) weight decay
+    params, m, v = START.copy(), 0.0, 0.0
+    for t, grad in enumerate(gradients, start=1):
+        if weight_decay and decoupled:
+            params = params - lr * weight_decay * params
+        elif weight_decay:
+            grad = grad + weight_decay * params
+        m = beta1 * m + (1 - beta1) * grad
+        v = beta2 * v + (1 - beta2) * grad ** 2
+        m_hat = m / (1 - beta1 ** t)
+        v_hat = v / (1 - beta2 ** t)
+        params = params - lr * m_hat / (np.sqrt(v_hat) + eps)
+    return params
+
+
+def test_sgd():
+    np.testing.assert_allclose(run(SGD(lr=0.1)), START - 0.1 * GRADIENTS.sum(axis=0))
+
+    velocity, expected = np.zeros(10), START.copy()
+    for grad in GRADIENTS:
+        velocity = 0.9 * velocity + grad + 0.01 * expected
+        expected = expected - 0.1 * velocity
+    np.testing.assert_allclose(run(SGD(lr=0.1, momentum=0.9, weight_decay=0.01)), expected)
+
+
+def test_adam():
+    np.testing.assert_allclose(run(Adam(lr=1e-2)), adam_reference(GRADIENTS, 1e-2))
+    np.testing.assert_allclose(run(Adam(lr=1e-2, weight_decay=0.1)),
+                               adam_reference(GRADIENTS, 1e-2, weight_decay=0.1))
+    ## the first step moves every parameter by about lr, against its gradient
+    first = run(Adam(lr=1e-2), GRADIENTS[:1])
+    np.testing.assert_allclose(first, START - 1e-2 * np.sign(GRADIENTS[0]), rtol=1e-6)
+
+
+def test_adamw():
+    np.testing.assert_allclose(run(AdamW(lr=1e-2, weight_decay=0.1)),
+                               adam_reference(GRADIENTS, 1e-2, weight_decay=0.1, decoupled=True))
+    ## with a zero gradient only the decay acts
+    params = START.copy()
+    AdamW(lr=1e-2, weight_decay=0.1).step(params, np.zeros(10))
+    np.testing.assert_allclose(params, START * (1 - 1e-3))
+
+
+@pytest.mark.parametrize('make', [lambda: SGD(lr=0.1, momentum=0.9), lambda: Adam(lr=1e-2), lambda: AdamW(lr=1e-2)])
+def test_state_dict_resumes(make):
+    ## three steps, then a fresh optimizer loaded from the state takes the last two
+    optimizer = make()
+    params = run(optimizer, GRADIENTS[:3])
+    resumed = make()
+    resumed.load_state_dict({key: None if value is None else np.copy(value)
+                             for key, value in optimizer.state_dict().items()})
+    for grad in GRADIENTS[3:]:
+        resumed.step(params, grad)
+    np.testing.assert_allclose(params, run(make()))
+
+
+def test_schedules():
+    optimizer = SGD(lr=step_schedule(1.0, step_size=2, gamma=0.5))
+    params = np.zeros(1)
+    for _ in range(5):
+        optimizer.step(params, np.ones(1))
+    assert params[0] == -(1 + 1 + 0.5 + 0.5 + 0.25)
+
+    schedule = cosine_schedule(1.0, max_steps=110, warmup_steps=10, min_lr=0.1)
+    assert schedule(0) == pytest.approx(0.1)
+    assert schedule(9) == pytest.approx(1.0)
+    assert schedule(60) == pytest.approx(0.1 + 0.9 * 0.5 * (1 + math.cos(math.pi / 2)))
+    assert schedule(110) == schedule(1000) == pytest.approx(0.1)
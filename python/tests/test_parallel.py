@@ -0,0 +1,52 @@
+import os
+import signal
+
+import numpy as np
+import pytest
+
+pytest.importorskip('bridgestan')
+
+from python.driver import StageDriver
+from python.parallel import DataParallel
+
+
+HYPERPARAMETERS = {'vocab_size': 65, 'batch_size': 8, 'block_size': 4}
+
+
+def batch(seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(1, 66, size=(8, 4)), rng.integers(1, 66, size=(8, 4))
+
+
+def test_gradient_matches_one_driver():
+    xb, yb = batch()
+    driver = StageDriver('01', HYPERPARAMETERS)
+    driver.load(driver.dump_data(xb, yb))
+    lp, grad = driver.log_density_gradient()
+    with DataParallel(driver, 4) as workers:
+        parallel_lp, parallel_grad = workers.log_density_gradient(xb, yb)
+        assert parallel_lp == pytest.approx(lp, rel=1e-12)
+        np.testing.assert_allclose(parallel_grad, grad, rtol=1e-10, atol=1e-14)
+        ## the workers read the driver's parameters from shared memory
+        driver.theta += 0.1
+        lp, grad = driver.log_density_gradient(driver.dump_data(xb, yb))
+        parallel_lp, parallel_grad = workers.log_density_gradient(xb, yb)
+        assert parallel_lp == pytest.approx(lp, rel=1e-12)
+        np.testing.assert_allclose(parallel_grad, grad, rtol=1e-10, atol=1e-14)
+
+
+def test_killed_worker_raises():
+    driver = StageDriver('01', HYPERPARAMETERS)
+    with DataParallel(driver, 2, timeout=60) as workers:
+        workers.log_density_gradient(*batch())
+        os.kill(workers._processes[1].pid, signal.SIGKILL)
+        with pytest.raises(RuntimeError, match="worker 1 exited"):
+            workers.log_density_gradient(*batch(1))
+
+
+def test_worker_error_raises():
+    driver = StageDriver('01', HYPERPARAMETERS)
+    xb, yb = batch()
+    with DataParallel(driver, 2, timeout=60) as workers:
+        with pytest.raises(RuntimeError, match="worker"):
+            workers.log_density_gradient(np.full_like(xb, 99), yb)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from python.params import ParameterManifest, ParameterState
+from python.stages import STAGES
+
+
+HYPERPARAMETERS = {'vocab_size': 65, 'batch_size': 4, 'block_size': 8, 'n_embed': 16, 'n_head': 2,
+                   'n_layer': 2, 'dropout': 0.2}
+
+
+def test_stage_parameters_in_declaration_order():
+    assert ParameterManifest.for_stage('01', HYPERPARAMETERS).names == ['token_embedding']
+    assert ParameterManifest.for_stage('07', HYPERPARAMETERS).names == [
+        'token_embedding', 'lm_head_multiplier', 'lm_head_offset', 'position_embedding',
+        'key', 'query', 'value', 'feed_forward_multiplier', 'feed_forward_offset']
+    manifest = ParameterManifest.for_stage('12', HYPERPARAMETERS)
+    assert manifest.names == [
+        'token_embedding', 'lm_head_multiplier', 'lm_head_offset', 'position_embedding',
+        'key', 'query', 'value', 'sa_proj_multiplier', 'sa_proj_offset',
+        'feed_forward_multiplier', 'feed_forward_offset', 'feed_forward_proj_multiplier',
+        'feed_forward_proj_offset', 'ln1_weight', 'ln1_bias', 'ln2_weight', 'ln2_bias',
+        'ln_f_weight', 'ln_f_bias']
+    assert manifest['key'].shape == (2, 2, 16, 8)
+    assert manifest['feed_forward_multiplier'].shape == (2, 64, 16)
+
+
+@pytest.mark.parametrize('stage', list(STAGES))
+def test_offsets_are_contiguous(stage):
+    manifest = ParameterManifest.for_stage(stage, HYPERPARAMETERS)
+    offset = 0
+    for spec in manifest:
+        assert spec.offset == offset
+        offset += int(np.prod(spec.shape))
+    assert manifest.size == offset
+    assert sorted(manifest.constrained_order()) == list(range(manifest.size))
+
+
+def test_constrained_order_is_column_major():
+    manifest = ParameterManifest([('a', (2, 3)), ('b', (2,))])
+    ## Stan lists a[1,1], a[2,1], a[1,2], ...; the buffer holds a row by row
+    np.testing.assert_array_equal(manifest.constrained_order(), [0, 3, 1, 4, 2, 5, 6, 7])
+    state = ParameterState(manifest, np.arange(8.0))
+    np.testing.assert_array_equal(state.values[manifest.constrained_order()],
+                                  np.concatenate([state['a'].ravel(order='F'), state['b']]))
+
+
+def test_state_round_trip_through_stan_variables():
+    manifest = ParameterManifest.for_stage('12', HYPERPARAMETERS)
+    state = ParameterState(manifest, np.random.default_rng(0).normal(size=manifest.size))
+    variables = state.stan_variables()
+    assert {name: value.shape for name, value in variables.items()} == \
+           {spec.name: spec.shape for spec in manifest}
+    ## views, not copies
+    variables['ln_f_bias'][0] = 7.0
+    assert state.values[manifest['ln_f_bias'].offset] == 7.0
+
+    copy = ParameterState.from_stan_variables(manifest, dict(variables, loss=-4.2))
+    np.testing.assert_array_equal(copy.values, state.values)
+    assert ParameterManifest.from_dict(manifest.to_dict()) == manifest
+
+
+def test_state_shape_errors():
+    manifest = ParameterManifest.for_stage('02', HYPERPARAMETERS)
+    with pytest.raises(ValueError):
+        ParameterState(manifest, np.zeros(manifest.size + 1))
+    variables = ParameterState(manifest).stan_variables()
+    variables['token_embedding'] = np.zeros((16, 65))
+    with pytest.raises(ValueError):
+        ParameterState.from_stan_variables(manifest, variables)
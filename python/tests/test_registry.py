@@ -0,0 +1,38 @@
+import os
+
+from python.registry import ModelRegistry
+
+
+class Build:
+    """Stands in for the compiler: writes an empty executable next to the source."""
+
+    def __init__(self):
+        self.runs = 0
+
+    def __call__(self, source):
+        self.runs += 1
+        artifact = source[:-len('.stan')]
+        open(artifact, 'w').close()
+        return artifact
+
+
+def test_builds_are_cached(tmp_path):
+    registry, build = ModelRegistry(str(tmp_path)), Build()
+    path = registry._artifact('01', {}, 'cmdstan', build, force=False)
+    assert os.path.isfile(path)
+    assert registry._artifact('01', {}, 'cmdstan', build, force=False) == path
+    assert build.runs == 1
+    registry._artifact('01', {}, 'cmdstan', build, force=True)
+    assert build.runs == 2
+
+
+def test_a_deleted_artifact_is_built_again(tmp_path):
+    registry, build = ModelRegistry(str(tmp_path)), Build()
+    path = registry._artifact('01', {}, 'cmdstan', build, force=False)
+    os.remove(path)
+    assert registry._artifact('01', {}, 'cmdstan', build, force=False) == path
+    assert os.path.isfile(path) and build.runs == 2
+    ## a build directory without its manifest
+    os.remove(os.path.join(os.path.dirname(path), 'model.json'))
+    assert registry._artifact('01', {}, 'cmdstan', build, force=False) == path
+    assert build.runs == 3
@@ -0,0 +1,116 @@
+import http.client
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+
+from python.inference import InferenceEngine
+from python.loadgen import run_load
+from python.params import ParameterManifest, ParameterState
+from python.server import BatchScheduler, make_server
+from python.streaming import stream_text
+from python.tokenizer import Tokenizer
+
+
+TOKENIZER = Tokenizer(" \nABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.,:;!?'-&$3")
+
+
+def engine():
+    hyperparameters = {'vocab_size': TOKENIZER.vocab_size, 'block_size': 8, 'n_embed': 16, 'n_head': 2,
+                       'n_layer': 2}
+    manifest = ParameterManifest.for_stage('12', hyperparameters)
+    state = ParameterState(manifest, np.random.default_rng(0).normal(0, 0.3, manifest.size))
+    return InferenceEngine(state.stan_variables(), '12')
+
+
+@pytest.fixture
+def server():
+    scheduler = BatchScheduler(engine(), TOKENIZER, max_batch_size=4)
+    server = make_server({'tiny': scheduler}, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    scheduler.close()
+
+
+def post(server, body):
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request('POST', '/generate', body if isinstance(body, str) else json.dumps(body))
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def test_generate_matches_stream_text(server):
+    status, body = post(server, {'prompt': "ROMEO:", 'max_new_tokens': 20, 'seed': 1})
+    assert status == 200
+    assert body['finish_reason'] == 'length' and body['tokens'] == 20
+    assert body['text'] == "".join(stream_text(engine(), TOKENIZER, "ROMEO:", max_new_tokens=20, seed=1))
+
+
+@pytest.mark.parametrize('body', ['[1, 2]', '"ROMEO:"', {'prompt': 5}, {'prompt': ["a"]},
+                                  {'max_new_tokens': 0}, {'temperature': -1}, {'temperature': 'nan'},
+                                  '{"temperature": Infinity}', {'top_k': 0}, {'max_new_tokens': 'many'},
+                                  {'model': 'huge'}])
+def test_bad_requests(server, body):
+    status, response = post(server, body)
+    assert status == 400 and 'error' in response
+
+
+def test_a_failed_prefill_only_fails_its_request(server):
+    scheduler = server.models['tiny']
+    forward = scheduler.engine.forward
+
+    def fail_once(*args, **kwargs):
+        scheduler.engine.forward = forward
+        raise FloatingPointError("prefill")
+
+    scheduler.engine.forward = fail_once
+    status, body = post(server, {'max_new_tokens': 5, 'seed': 0})
+    assert status == 200 and body['finish_reason'].startswith('error')
+    status, body = post(server, {'max_new_tokens': 5, 'seed': 0})
+    assert status == 200 and body['finish_reason'] == 'length'
+    assert scheduler.stats()['running'] == 0
+
+
+def test_a_disconnected_client_frees_its_slot(server):
+    scheduler = server.models['tiny']
+    connection = http.client.HTTPConnection(*server.server_address)
+    connection.request('POST', '/generate', json.dumps({'max_new_tokens': 10**7}))
+    while scheduler.stats()['running'] == 0:
+        time.sleep(0.01)
+    connection.close()
+    deadline = time.monotonic() + 5
+    while scheduler.stats()['running'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert scheduler.stats()['running'] == 0
+
+
+class CutOff(BaseHTTPRequestHandler):
+    ## one piece of text, then the stream ends without its 'done' line
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        self.wfile.write(b'{"text": "a"}\n')
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_load_generator_counts_cut_off_streams_as_errors():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CutOff)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        report = run_load(f'http://127.0.0.1:{server.server_address[1]}', n_requests=6, concurrency=2,
+                          max_new_tokens=5)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert report['requests'] == 0 and report['errors'] == 6
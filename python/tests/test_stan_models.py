@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('bridgestan')
+
+from python.driver import StageDriver
+from python.inference import InferenceEngine
+from python.stages import STAGES
+
+
+HYPERPARAMETERS = {'vocab_size': 65, 'batch_size': 4, 'block_size': 8, 'n_embed': 16, 'n_head': 2,
+                   'n_layer': 2, 'dropout': 0.0}
+
+
+def batch():
+    rng = np.random.default_rng(0)
+    return rng.integers(1, 66, size=(4, 8)), rng.integers(1, 66, size=(4, 8))
+
+
+def mean_log_likelihood(logits, yb):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    logits -= np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+    return np.take_along_axis(logits, np.asarray(yb)[..., None] - 1, axis=-1).mean()
+
+
+## At a large parameter scale the attention scores of different rows sit hundreds
+## apart; every row of the softmax has to be normalized on its own or it underflows.
+@pytest.mark.parametrize('stage', ['05', '07', '12'])
+@pytest.mark.parametrize('scale', [0.1, 3.0, 10.0])
+def test_loss_matches_numpy_forward_pass(stage, scale):
+    xb, yb = batch()
+    driver = StageDriver(stage, HYPERPARAMETERS)
+    driver.load(driver.dump_data(xb, yb))
+    driver.theta = np.random.default_rng(1).normal(0, scale, len(driver.theta))
+
+    loss = driver.loss()
+    assert np.isfinite(loss)
+    assert np.isfinite(driver.log_density_gradient()[1]).all()
+
+    engine = InferenceEngine(driver.get_state().stan_variables(), stage)
+    assert loss == pytest.approx(mean_log_likelihood(engine.forward(xb), yb), rel=1e-8, abs=1e-8)
+
+
+## the vectorized layer norm, feed forward and lm_head compute what the
+## NumPy engine does one position at a time
+@pytest.mark.parametrize('stage', list(STAGES))
+def test_every_stage_matches_numpy_forward_pass(stage):
+    xb, yb = batch()
+    driver = StageDriver(stage, HYPERPARAMETERS)
+    driver.load(driver.dump_data(xb, yb))
+    driver.theta = np.random.default_rng(1).normal(0, 0.3, len(driver.theta))
+    engine = InferenceEngine(driver.get_state().stan_variables(), stage)
+    assert driver.loss() == pytest.approx(mean_log_likelihood(engine.forward(xb), yb), rel=1e-10)
+
+
+## the gradient of the single categorical_logit_glm call against central differences
+@pytest.mark.parametrize('stage', ['01', '07', '12'])
+def test_gradient_matches_finite_differences(stage):
+    xb, yb = batch()
+    driver = StageDriver(stage, HYPERPARAMETERS)
+    driver.load(driver.dump_data(xb, yb))
+    theta = np.random.default_rng(1).normal(0, 0.3, len(driver.theta))
+    _, grad = driver.log_density_gradient(theta=theta)
+    eps = 1e-6
+    for i in np.random.default_rng(2).choice(len(theta), 10, replace=False):
+        step = np.zeros(len(theta))
+        step[i] = eps
+        numeric = (driver.log_density(theta=theta + step) - driver.log_density(theta=theta - step)) / (2 * eps)
+        assert grad[i] == pytest.approx(numeric, rel=1e-5, abs=1e-7)
+
+
+## reduce_sum only reorders the sum over sequences
+def test_threads_per_step_matches_serial():
+    xb, yb = batch()
+    serial = StageDriver('12', HYPERPARAMETERS)
+    threaded = StageDriver('12', HYPERPARAMETERS, threads_per_step=2)
+    serial.load(serial.dump_data(xb, yb))
+    theta = np.random.default_rng(1).normal(0, 0.3, len(serial.theta))
+    lp, grad = serial.log_density_gradient(theta=theta)
+    threaded_lp, threaded_grad = threaded.log_density_gradient(threaded.dump_data(xb, yb), theta=theta)
+    assert threaded_lp == pytest.approx(lp, rel=1e-12)
+    np.testing.assert_allclose(threaded_grad, grad, rtol=1e-10, atol=1e-14)
+
+
+## equal embeddings make every row layer norm sees constant: its variance is zero
+@pytest.mark.parametrize('stage', ['09', '12'])
+def test_layer_norm_of_a_constant_row_has_a_finite_gradient(stage):
+    xb, yb = batch()
+    driver = StageDriver(stage, HYPERPARAMETERS)
+    driver.load(driver.dump_data(xb, yb))
+    state = driver.get_state()
+    state['token_embedding'][...] = 0.5
+    state['position_embedding'][...] = 0.25
+    driver.set_state(state)
+    lp, grad = driver.log_density_gradient()
+    assert np.isfinite(lp) and np.isfinite(grad).all()
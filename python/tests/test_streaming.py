@@ -0,0 +1,86 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from python.inference import InferenceEngine
+from python.params import ParameterManifest, ParameterState
+from python.streaming import TextStream, astream_text, stream_text, stream_tokens
+from python.tokenizer import Tokenizer
+
+
+TOKENIZER = Tokenizer(" \nABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.,:;!?'-&$3")
+
+
+def engine(stage='12'):
+    hyperparameters = {'vocab_size': TOKENIZER.vocab_size, 'block_size': 8, 'n_embed': 16, 'n_head': 2,
+                       'n_layer': 2}
+    manifest = ParameterManifest.for_stage(stage, hyperparameters)
+    state = ParameterState(manifest, np.random.default_rng(0).normal(0, 0.3, manifest.size))
+    return InferenceEngine(state.stan_variables(), stage)
+
+
+def pieces(text, stop=None):
+    stream = TextStream(TOKENIZER, stop)
+    out = [stream.push(token) for token in TOKENIZER.encode(text)]
+    return out, stream
+
+
+def test_no_stop_string():
+    out, stream = pieces("To be")
+    assert out == ["T", "o", " ", "b", "e"]
+    assert not stream.stopped
+    assert stream.flush() == ""
+
+
+def test_start_of_a_stop_string_is_held_back():
+    out, stream = pieces("ab\n\ncd", stop="\n\n")
+    ## the first newline waits for the next character, which completes the stop string
+    assert out == ["a", "b", "", "", "", ""]
+    assert stream.stopped
+    assert stream.flush() == ""
+
+
+def test_held_back_text_is_released():
+    out, stream = pieces("a\nb\n", stop="\n\n")
+    assert out == ["a", "", "\nb", ""]
+    ## generation ended for another reason: what is held back is text after all
+    assert stream.flush() == "\n"
+    assert not stream.stopped
+
+
+def test_earliest_of_several_stop_strings():
+    out, stream = pieces("one: two. three", stop=["three", ". ", ":"])
+    assert "".join(out) == "one"
+    assert stream.stopped
+    assert stream.push(TOKENIZER.encode("x")[0]) == ""
+
+
+def test_stream_tokens_match_generate():
+    e = engine()
+    tokens = list(stream_tokens(e, max_new_tokens=30, seed=3, temperature=0.8, top_k=10))
+    np.testing.assert_array_equal(tokens, e.generate(max_new_tokens=30, seed=3, temperature=0.8, top_k=10)[1:])
+
+
+@pytest.mark.parametrize('stage', ['01', '04', '12'])
+def test_stream_text_matches_generate(stage):
+    e = engine(stage)
+    expected = TOKENIZER.decode(e.generate(TOKENIZER.encode("ROMEO:"), max_new_tokens=40, seed=1)[6:])
+    assert "".join(stream_text(e, TOKENIZER, "ROMEO:", max_new_tokens=40, seed=1)) == expected
+
+
+def test_stream_text_stops():
+    e = engine()
+    text = "".join(stream_text(e, TOKENIZER, max_new_tokens=200, seed=0))
+    stop = text[50:52]
+    stopped = "".join(stream_text(e, TOKENIZER, max_new_tokens=200, seed=0, stop=stop))
+    assert stopped == text[:text.index(stop)]
+
+
+def test_astream_text():
+    e = engine()
+
+    async def collect():
+        return [piece async for piece in astream_text(e, TOKENIZER, "ROMEO:", max_new_tokens=20, seed=2)]
+
+    assert asyncio.run(collect()) == list(stream_text(e, TOKENIZER, "ROMEO:", max_new_tokens=20, seed=2))
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from python.data import TINYSHAKESPEARE
+from python.tokenizer import Tokenizer, encoder_decoder_1_indexed
+
+
+TEXT = "First Citizen:\nBefore we proceed any further, hear me speak.\n\nAll:\nSpeak, speak.\n"
+
+
+def test_round_trip():
+    tokenizer = Tokenizer.from_text(TEXT)
+    tokens = tokenizer.encode(TEXT)
+    assert tokens.dtype == np.uint8
+    assert tokenizer.decode(tokens) == TEXT
+    assert ''.join(tokenizer.decode_token(token) for token in tokens) == TEXT
+
+
+def test_same_ids_as_a_dictionary_of_sorted_characters():
+    ## the vocabulary the Stan data was always built with: sorted characters, numbered from 1
+    stoi = {c: i + 1 for i, c in enumerate(sorted(set(TEXT)))}
+    encode, decode = encoder_decoder_1_indexed(TEXT)
+    np.testing.assert_array_equal(encode(TEXT), [stoi[c] for c in TEXT])
+    assert decode([stoi[c] for c in "hear me"]) == "hear me"
+
+
+def test_decode_accepts_stan_output():
+    ## stan_variable('new_tokens') comes back as floats
+    tokenizer = Tokenizer.from_text(TEXT)
+    assert tokenizer.decode(tokenizer.encode("speak").astype(np.float64)) == "speak"
+    assert tokenizer.decode([]) == ""
+
+
+def test_unknown_tokens_and_characters():
+    tokenizer = Tokenizer.from_text(TEXT)
+    with pytest.raises(KeyError):
+        tokenizer.encode("speak?")
+    with pytest.raises(KeyError):
+        tokenizer.decode([1, 0])
+    with pytest.raises(KeyError):
+        tokenizer.decode_token(tokenizer.vocab_size + 1)
+    with pytest.raises(ValueError):
+        Tokenizer.from_text("café ☃")
+
+
+def test_corpus_round_trip():
+    with open(TINYSHAKESPEARE, 'r', encoding='utf-8') as f:
+        text = f.read()
+    tokenizer = Tokenizer.from_text(text)
+    assert tokenizer.vocab_size == 65
+    assert tokenizer.decode(tokenizer.encode(text)) == text
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+from python.metrics import MetricsLog, read_metrics, summarize
+from python.optim import SGD, AdamW
+from python.stages import get_stage
+from python.train import train
+
+
+V = 11
+
+
+class BigramDriver:
+    """The log density and gradient of stage 01 in NumPy, with StageDriver's interface."""
+
+    def __init__(self):
+        self.stage = get_stage('01')
+        self.hyperparameters = {'vocab_size': V}
+        self.theta = np.random.default_rng(0).uniform(-0.1, 0.1, V * V)
+
+    def dump_data(self, xb, yb, **overrides):
+        return np.asarray(xb) - 1, np.asarray(yb) - 1
+
+    def _log_softmax(self, data, theta):
+        xb, yb = data
+        logits = (self.theta if theta is None else theta).reshape(V, V)[xb]
+        logits = logits - logits.max(axis=-1, keepdims=True)
+        return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True)), yb
+
+    def loss(self, data, theta=None):
+        log_p, yb = self._log_softmax(data, theta)
+        return np.take_along_axis(log_p, yb[..., None], axis=-1).mean()
+
+    def log_density_gradient(self, data, theta=None, out=None):
+        ## d/dlogits of the mean log likelihood: (one_hot(y) - softmax) / N
+        log_p, yb = self._log_softmax(data, theta)
+        xb, _ = data
+        d_logits = -np.exp(log_p)
+        np.put_along_axis(d_logits, yb[..., None], np.take_along_axis(d_logits, yb[..., None], axis=-1) + 1,
+                          axis=-1)
+        d_logits /= yb.size
+        grad = np.zeros((V, V))
+        np.add.at(grad, xb.ravel(), d_logits.reshape(-1, V))
+        if out is None:
+            out = np.empty(V * V)
+        out[:] = grad.ravel()
+        return self.loss(data, theta), out
+
+
+def batches(seed, batch_size=4, block_size=5):
+    rng = np.random.default_rng(seed)
+    return lambda: (rng.integers(1, V + 1, (batch_size, block_size)), rng.integers(1, V + 1, (batch_size, block_size)))
+
+
+def test_bigram_gradient():
+    driver = BigramDriver()
+    data = driver.dump_data(*batches(0)())
+    _, grad = driver.log_density_gradient(data)
+    eps = 1e-6
+    for i in np.random.default_rng(1).choice(V * V, 10, replace=False):
+        step = np.zeros(V * V)
+        step[i] = eps
+        numeric = (driver.loss(data, driver.theta + step) - driver.loss(data, driver.theta - step)) / (2 * eps)
+        assert grad[i] == pytest.approx(numeric, abs=1e-8)
+
+
+@pytest.mark.parametrize('optimizer', [lambda: SGD(lr=0.5), lambda: AdamW(lr=1e-2)])
+def test_accumulation_equals_the_full_batch(optimizer):
+    ## K micro-batches of B sequences per step take the same steps as one batch of K * B
+    K, B = 4, 3
+    micro = BigramDriver()
+    train(micro, optimizer(), batches(7, B), max_iters=5, eval_interval=0, prefetch=0, accumulation_steps=K)
+
+    draw = batches(7, B)
+
+    def full_batch():
+        xs, ys = zip(*(draw() for _ in range(K)))
+        return np.concatenate(xs), np.concatenate(ys)
+
+    full = BigramDriver()
+    train(full, optimizer(), full_batch, max_iters=5, eval_interval=0, prefetch=0)
+    np.testing.assert_allclose(micro.theta, full.theta, rtol=1e-12, atol=1e-15)
+
+
+def test_prefetching_draws_the_same_batches():
+    driver, prefetched = BigramDriver(), BigramDriver()
+    train(driver, SGD(lr=0.5), batches(3), max_iters=10, eval_interval=0, prefetch=0, accumulation_steps=2)
+    train(prefetched, SGD(lr=0.5), batches(3), max_iters=10, eval_interval=0, prefetch=2, accumulation_steps=2)
+    np.testing.assert_array_equal(driver.theta, prefetched.theta)
+
+
+def test_evaluation_steps():
+    evaluations = []
+    history = train(BigramDriver(), SGD(lr=0.5), batches(0), max_iters=7, get_val_batch=batches(1),
+                    eval_interval=3, eval_iters=2, prefetch=0,
+                    on_eval=lambda step, losses, new_tokens: evaluations.append((step, new_tokens)))
+    assert [step for step, _ in history] == [0, 3, 6]
+    assert evaluations == [(0, None), (3, None), (6, None)]
+    assert set(history[0][1]) == {'train', 'val'}
+
+
+def test_accumulation_steps_must_be_positive():
+    with pytest.raises(ValueError):
+        train(BigramDriver(), SGD(), batches(0), max_iters=1, accumulation_steps=0)
+
+
+@pytest.mark.parametrize('separate_sampler', [False, True])
+def test_seeded_runs_with_evaluation_are_reproducible(separate_sampler):
+    ## the train-split estimate must not draw from the sampler the prefetch thread is using
+    def run(prefetch):
+        driver = BigramDriver()
+        history = train(driver, SGD(lr=0.5), batches(3), max_iters=20, get_val_batch=batches(4),
+                        eval_interval=4, eval_iters=3, prefetch=prefetch, on_eval=lambda *args: None,
+                        get_train_eval_batch=batches(5) if separate_sampler else None)
+        return driver.theta, history
+
+    theta, history = run(0)
+    for prefetch in (1, 2, 2, 4):
+        other_theta, other_history = run(prefetch)
+        np.testing.assert_array_equal(other_theta, theta)
+        assert other_history == history
+
+
+def test_metrics_summary_has_the_losses_of_the_last_run(tmp_path):
+    path = tmp_path / 'metrics.jsonl'
+    for max_iters in (7, 5):
+        with MetricsLog(path, '01') as metrics:
+            history = train(BigramDriver(), SGD(lr=0.5), batches(0), max_iters=max_iters, get_val_batch=batches(1),
+                            eval_interval=3, eval_iters=2, prefetch=0, on_eval=lambda *args: None, metrics=metrics)
+    summary = summarize(read_metrics(path))['01-bigram']
+    ## the rerun replaces the first run instead of adding to it
+    assert summary['steps'] == 5
+    assert summary['loss'] == history[-1][1]['train']
+    assert summary['loss_validation'] == history[-1][1]['val']